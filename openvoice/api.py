@@ -2,24 +2,50 @@ import torch
 import numpy as np
 import re
 import soundfile
+from contextlib import contextmanager
 from openvoice import utils
 from openvoice import commons
+from openvoice import pipeline
+from openvoice import streaming
+from openvoice import watermark
+from openvoice import torchscript
+from openvoice import quantization
 import os
 import librosa
 from openvoice.text import text_to_sequence
-from openvoice.mel_processing import spectrogram_torch
+from openvoice.mel_processing import SpectrogramExtractor
 from openvoice.models import SynthesizerTrn
 
 
 class OpenVoiceBaseClass(object):
+    # submodules inference never runs, dropped by optimize_for_inference
+    unused_modules = ()
+    # entry points run as TorchScript after enable_torchscript
+    torchscript_entry_points = ()
+
     def __init__(self, 
                 config_path, 
-                device='cuda:0'):
+                device='cuda:0',
+                precision='fp32'):
         if 'cuda' in device:
             assert torch.cuda.is_available()
+        assert precision in ('fp32', 'bf16'), f"precision {precision} is not supported"
 
         hps = utils.get_hparams_from_file(config_path)
 
+        self.model = self.build_model(hps, device)
+        self.hps = hps
+        self.config_path = config_path
+        self.ckpt_path = None
+        self.device = device
+        # 'bf16' runs the conv stacks under bfloat16 autocast, numerically sensitive steps stay fp32
+        self.precision = precision
+        # per-stage wall time of the last call, see pipeline.StageTimer.summary
+        self.last_timings = {}
+        self.inference_optimized = False
+        self.quantized = False
+
+    def build_model(self, hps, device):
         model = SynthesizerTrn(
             len(getattr(hps, 'symbols', [])),
             hps.data.filter_length // 2 + 1,
@@ -28,15 +54,128 @@ class OpenVoiceBaseClass(object):
         ).to(device)
 
         model.eval()
-        self.model = model
-        self.hps = hps
-        self.device = device
+        return model
 
     def load_ckpt(self, ckpt_path):
         checkpoint_dict = torch.load(ckpt_path, map_location=torch.device(self.device))
         a, b = self.model.load_state_dict(checkpoint_dict['model'], strict=False)
         print("Loaded checkpoint '{}'".format(ckpt_path))
         print('missing/unexpected keys:', a, b)
+        self.ckpt_path = ckpt_path
+
+    def enable_torchscript(self, cache=True):
+        """
+        Opt-in: run the torchscript_entry_points as TorchScript traces, see openvoice.torchscript.
+        Call it after load_ckpt. With cache, the traces are saved next to the checkpoint and
+        loaded from there by later processes.
+        """
+        # an int8 model traces differently from the fp32 model of the same checkpoint
+        variant = f'{self.precision}:{"int8" if self.quantized else "fp32"}'
+        for name in self.torchscript_entry_points:
+            self.model.compiled[name] = torchscript.load_or_trace(name, self.model, self.hps, self.config_path,
+                                                                  self.ckpt_path, self.device, cache=cache,
+                                                                  variant=variant)
+        return self
+
+    @contextmanager
+    def inference_context(self):
+        grad_mode = torch.inference_mode() if self.inference_optimized else torch.no_grad()
+        with grad_mode, torch.autocast(device_type=torch.device(self.device).type, dtype=torch.bfloat16,
+                                       enabled=self.precision == 'bf16'):
+            yield
+
+    def optimize_for_inference(self, check=False):
+        """
+        Prepare the loaded model for inference only: weight norms are folded into plain weights,
+        submodules inference never runs are dropped and model calls run under torch.inference_mode.
+        Call it after load_ckpt, the checkpoint layout no longer matches the model afterwards.
+        check: compare the outputs with those of the unoptimized model, they must be bit-identical
+        """
+        expected = self.check_outputs() if check else None
+        self.model.remove_weight_norm()
+        for name in self.unused_modules:
+            if hasattr(self.model, name):
+                delattr(self.model, name)
+        self.model.requires_grad_(False)
+        self.inference_optimized = True
+        if check:
+            for e, a in zip(expected, self.check_outputs()):
+                assert e.shape == a.shape and torch.equal(e, a), \
+                    f"optimized model deviates from the original by {(e - a).abs().max().item()}"
+            print("Optimized model matches the original bit for bit.")
+        return self
+
+    def check_precision(self, max_rel_deviation=0.05):
+        """
+        Relative RMS deviation of the bf16 outputs from the fp32 ones, on the check inputs.
+        Fails when an output deviates by more than max_rel_deviation.
+        """
+        precision = self.precision
+        try:
+            self.precision = 'fp32'
+            expected = self.check_outputs()
+            self.precision = 'bf16'
+            actual = self.check_outputs()
+        finally:
+            self.precision = precision
+        deviations = [((a.float() - e).pow(2).mean() / e.pow(2).mean().clamp(min=1e-12)).sqrt().item()
+                      for e, a in zip(expected, actual)]
+        print('relative rms deviation, bf16 vs fp32:', ['{:.4f}'.format(d) for d in deviations])
+        for deviation in deviations:
+            assert deviation <= max_rel_deviation, f"bf16 output deviates from fp32 by {deviation:.4f}"
+        return deviations
+
+    def quantize(self, calibration_data=None, static_convs=True):
+        """
+        Switch to int8 CPU inference, see openvoice.quantization: dynamic int8 Linear / GRU layers and,
+        with static_convs, per-channel int8 Conv1d layers in the Generator and WN stacks.
+        calibration_data: inputs of calibrate(), their activation ranges set the conv quantization.
+        Without it the ranges are left uncalibrated, as needed before load_quantized_ckpt.
+        """
+        assert not self.quantized, "the model is already quantized"
+        if not self.inference_optimized:
+            self.optimize_for_inference()
+        # traces of the fp32 model are dropped, call enable_torchscript again to trace the int8 one
+        self.model.compiled.clear()
+        quantization.quantize_dynamic(self.model)
+        if static_convs:
+            quantization.prepare_static(self.model)
+            for item in calibration_data or []:
+                self.calibrate(item)
+            quantization.convert_static(self.model)
+        self.quantized = True
+        return self
+
+    def calibrate(self, item):
+        raise NotImplementedError
+
+    def save_quantized_ckpt(self, ckpt_path):
+        assert self.quantized, "call quantize() first"
+        torch.save({'model': self.model.state_dict(), 'quantized': True}, ckpt_path)
+        print("Saved int8 checkpoint '{}'".format(ckpt_path))
+
+    def load_quantized_ckpt(self, ckpt_path, static_convs=True):
+        """Load a checkpoint written by save_quantized_ckpt, no calibration data is needed."""
+        if not self.quantized:
+            self.quantize(static_convs=static_convs)
+        checkpoint_dict = torch.load(ckpt_path, map_location='cpu')
+        self.model.load_state_dict(checkpoint_dict['model'])
+        self.ckpt_path = ckpt_path
+        print("Loaded int8 checkpoint '{}'".format(ckpt_path))
+
+    def check_outputs(self):
+        # deterministic inputs (no sampling noise), so the outputs only depend on the weights.
+        # the model runs once before, first calls may pick other conv kernels
+        inputs = self.check_inputs(torch.Generator().manual_seed(0))
+        with self.inference_context():
+            self.check_forward(*inputs)
+            return self.check_forward(*inputs)
+
+    def check_inputs(self, generator):
+        raise NotImplementedError
+
+    def check_forward(self, *inputs):
+        raise NotImplementedError
 
 
 class BaseSpeakerTTS(OpenVoiceBaseClass):
@@ -44,6 +183,9 @@ class BaseSpeakerTTS(OpenVoiceBaseClass):
         "english": "EN",
         "chinese": "ZH",
     }
+    # the posterior encoder is only used in training
+    unused_modules = ('enc_q',)
+    torchscript_entry_points = ('flow_decoder',)
 
     @staticmethod
     def get_text(text, hps, is_symbol):
@@ -53,6 +195,20 @@ class BaseSpeakerTTS(OpenVoiceBaseClass):
         text_norm = torch.LongTensor(text_norm)
         return text_norm
 
+    def calibrate(self, item):
+        # the config does not tell an English from a Chinese model, so the language is always given
+        assert isinstance(item, (list, tuple)) and len(item) == 3, \
+            f"calibration data of BaseSpeakerTTS are (text, speaker, language) tuples, got {item!r}"
+        text, speaker, language = item
+        self.tts(text, None, speaker, language=language)
+
+    def check_inputs(self, generator):
+        x = torch.randint(1, len(self.hps.symbols), (1, 64), generator=generator).to(self.device)
+        return x, torch.LongTensor([x.size(1)]).to(self.device), torch.LongTensor([0]).to(self.device)
+
+    def check_forward(self, x, x_lengths, sid):
+        return self.model.infer(x, x_lengths, sid=sid, noise_scale=0., noise_scale_w=0.)[:1]
+
     @staticmethod
     def audio_numpy_concat(segment_data_list, sr, speed=1.):
         audio_segments = []
@@ -70,27 +226,75 @@ class BaseSpeakerTTS(OpenVoiceBaseClass):
         print(" > ===========================")
         return texts
 
-    def tts(self, text, output_path, speaker, language='English', speed=1.0):
+    def infer_batch(self, stn_tsts, speaker_id, speed=1.0):
+        device = self.device
+        x_lengths = torch.LongTensor([stn_tst.size(0) for stn_tst in stn_tsts])
+        x_tst = torch.zeros(len(stn_tsts), int(x_lengths.max()), dtype=torch.long)
+        for i, stn_tst in enumerate(stn_tsts):
+            x_tst[i, :stn_tst.size(0)] = stn_tst
+        with self.inference_context():
+            x_tst = x_tst.to(device)
+            x_tst_lengths = x_lengths.to(device)
+            sid = torch.LongTensor([speaker_id] * len(stn_tsts)).to(device)
+            o, _, y_mask, _ = self.model.infer(x_tst, x_tst_lengths, sid=sid, noise_scale=0.667, noise_scale_w=0.6,
+                                length_scale=1.0 / speed)
+            # cut every waveform back to its own length, padded frames are masked out by y_mask
+            hop_length = o.size(-1) // y_mask.size(-1)
+            y_lengths = (y_mask.sum([1, 2]).long() * hop_length).tolist()
+            audios = o[:, 0].data.cpu().float().numpy()
+        return [audios[i, :y_lengths[i]] for i in range(len(stn_tsts))]
+
+    def text_to_sequences(self, texts, mark):
+        stn_tsts = []
+        for t in texts:
+            t = re.sub(r'([a-z])([A-Z])', r'\1 \2', t)
+            t = f'[{mark}]{t}[{mark}]'
+            stn_tsts.append(self.get_text(t, self.hps, False))
+        return stn_tsts
+
+    def tts_stream(self, text, speaker, language='English', speed=1.0, prefetch=4):
+        """
+        Yield the waveform of every sentence, followed by its sentence gap, as soon as it is synthesized.
+        Concatenated, the pieces are what tts() returns.
+        """
         mark = self.language_marks.get(language.lower(), None)
         assert mark is not None, f"language {language} is not supported"
 
+        timer = pipeline.StageTimer()
         texts = self.split_sentences_into_pieces(text, mark)
+        speaker_id = self.hps.speakers[speaker]
+        gap = streaming.sentence_gap(self.hps.data.sampling_rate, speed)
+        frontend = pipeline.prefetch_map(lambda t: self.text_to_sequences([t], mark)[0], texts,
+                                         depth=prefetch, timer=timer)
+        for stn_tst in frontend:
+            with timer.stage('inference'):
+                audio = self.infer_batch([stn_tst], speaker_id, speed=speed)[0]
+            self.last_timings = timer.summary()
+            yield np.concatenate([audio.reshape(-1), gap])
 
-        audio_list = []
-        for t in texts:
-            t = re.sub(r'([a-z])([A-Z])', r'\1 \2', t)
-            t = f'[{mark}]{t}[{mark}]'
-            stn_tst = self.get_text(t, self.hps, False)
-            device = self.device
-            speaker_id = self.hps.speakers[speaker]
-            with torch.no_grad():
-                x_tst = stn_tst.unsqueeze(0).to(device)
-                x_tst_lengths = torch.LongTensor([stn_tst.size(0)]).to(device)
-                sid = torch.LongTensor([speaker_id]).to(device)
-                audio = self.model.infer(x_tst, x_tst_lengths, sid=sid, noise_scale=0.667, noise_scale_w=0.6,
-                                    length_scale=1.0 / speed)[0][0, 0].data.cpu().float().numpy()
-            audio_list.append(audio)
-        audio = self.audio_numpy_concat(audio_list, sr=self.hps.data.sampling_rate, speed=speed)
+    def tts(self, text, output_path, speaker, language='English', speed=1.0, batch_size=1, prefetch=4):
+        mark = self.language_marks.get(language.lower(), None)
+        assert mark is not None, f"language {language} is not supported"
+
+        timer = pipeline.StageTimer()
+        texts = self.split_sentences_into_pieces(text, mark)
+        speaker_id = self.hps.speakers[speaker]
+
+        # buckets are formed from the raw text length, so cleaning and phonemization of the
+        # next buckets run in the frontend pool while the model works on the current one.
+        # sentences of similar length are synthesized together in one forward pass
+        buckets = commons.bucket_by_length([len(t) for t in texts], batch_size)
+        frontend = pipeline.prefetch_map(lambda bucket: self.text_to_sequences([texts[i] for i in bucket], mark),
+                                         buckets, depth=prefetch, timer=timer)
+        audio_list = [None] * len(texts)
+        for bucket, stn_tsts in zip(buckets, frontend):
+            with timer.stage('inference'):
+                audios = self.infer_batch(stn_tsts, speaker_id, speed=speed)
+            for i, audio in zip(bucket, audios):
+                audio_list[i] = audio
+        with timer.stage('concat'):
+            audio = self.audio_numpy_concat(audio_list, sr=self.hps.data.sampling_rate, speed=speed)
+        self.last_timings = timer.summary()
 
         if output_path is None:
             return audio
@@ -99,104 +303,260 @@ class BaseSpeakerTTS(OpenVoiceBaseClass):
 
 
 class ToneColorConverter(OpenVoiceBaseClass):
+    # text encoder, duration predictors and speaker table belong to the TTS models
+    unused_modules = ('enc_p', 'sdp', 'dp', 'emb_g')
+    torchscript_entry_points = ('voice_conversion',)
+
     def __init__(self, *args, **kwargs):
+        enable_watermark = kwargs.pop('enable_watermark', True)
         super().__init__(*args, **kwargs)
 
-        if kwargs.get('enable_watermark', True):
-            import wavmark
-            self.watermark_model = wavmark.load_model().to(self.device)
-        else:
-            self.watermark_model = None
+        # the wavmark model is only loaded when the first watermark is added or detected
+        self.enable_watermark = enable_watermark
+        self._watermark_model = None
         self.version = getattr(self.hps, '_version_', "v1")
+        # STFT window and bases are built once, not on every extract_se / convert call
+        self.spectrogram = SpectrogramExtractor.from_hparams(self.hps.data)
+
+    def calibrate(self, item):
+        # a reference clip (path or waveform), converted back to its own tone color
+        se = self.extract_se(item)
+        self.convert(item, se, se, tau=0.)
+
+    def check_inputs(self, generator):
+        spec = torch.rand(1, self.hps.data.filter_length // 2 + 1, 200, generator=generator).to(self.device)
+        return spec, torch.LongTensor([spec.size(-1)]).to(self.device)
+
+    def check_forward(self, spec, spec_lengths):
+        se = self.model.ref_enc(spec.transpose(1, 2)).unsqueeze(-1)
+        o_hat = self.model.voice_conversion(spec, spec_lengths, sid_src=se, sid_tgt=se.flip(1), tau=0.)[0]
+        return se, o_hat
+
+    @property
+    def watermark_model(self):
+        if self._watermark_model is None and self.enable_watermark:
+            self._watermark_model = watermark.get_watermark_model(self.device)
+        return self._watermark_model
 
+    @watermark_model.setter
+    def watermark_model(self, model):
+        self._watermark_model = model
+        self.enable_watermark = model is not None
 
+    def extract_se(self, ref_wav_list, se_save_path=None, sr=None, batch_size=32):
+        """
+        ref_wav_list: a path / waveform, or a list of them
+        sr: sampling rate of in-memory waveforms, they are resampled only if it differs from the model's
+        The tone color is the mean of the segment embeddings, see embed_segments.
+        """
+        gs = self.embed_segments(ref_wav_list, sr=sr, batch_size=batch_size).mean(0)
+
+        if se_save_path is not None:
+            os.makedirs(os.path.dirname(se_save_path), exist_ok=True)
+            torch.save(gs.cpu(), se_save_path)
 
-    def extract_se(self, ref_wav_list, se_save_path=None):
-        if isinstance(ref_wav_list, str):
+        return gs
+
+    def embed_segments(self, ref_wav_list, sr=None, batch_size=32):
+        """
+        Embedding of every segment, [n_segments, 1, gin_channels, 1].
+        Segments are bucketed by length and every bucket goes through the reference encoder in one pass.
+        """
+        if not isinstance(ref_wav_list, (list, tuple)):
             ref_wav_list = [ref_wav_list]
         
         device = self.device
-        hps = self.hps
-        gs = []
+        specs = []
         
-        for fname in ref_wav_list:
-            audio_ref, sr = librosa.load(fname, sr=hps.data.sampling_rate)
-            y = torch.FloatTensor(audio_ref)
+        for ref_wav in ref_wav_list:
+            y = self._load_audio(ref_wav, sr=sr)
             y = y.to(device)
             y = y.unsqueeze(0)
-            y = spectrogram_torch(y, hps.data.filter_length,
-                                        hps.data.sampling_rate, hps.data.hop_length, hps.data.win_length,
-                                        center=False).to(device)
-            with torch.no_grad():
-                g = self.model.ref_enc(y.transpose(1, 2)).unsqueeze(-1)
-                gs.append(g.detach())
-        gs = torch.stack(gs).mean(0)
+            y = self.spectrogram(y)
+            specs.append(y[0].transpose(0, 1))
+        spec_lengths = [spec.size(0) for spec in specs]
 
-        if se_save_path is not None:
-            os.makedirs(os.path.dirname(se_save_path), exist_ok=True)
-            torch.save(gs.cpu(), se_save_path)
+        gs = [None] * len(specs)
+        for bucket in commons.bucket_by_length(spec_lengths, batch_size):
+            y = torch.zeros(len(bucket), max(spec_lengths[i] for i in bucket), specs[0].size(1), device=device)
+            for j, i in enumerate(bucket):
+                y[j, :spec_lengths[i]] = specs[i]
+            mask = None
+            if len(bucket) > 1:
+                lengths = torch.LongTensor([spec_lengths[i] for i in bucket]).to(device)
+                mask = commons.sequence_mask(lengths, y.size(1)).float()
+            with self.inference_context():
+                g = self.model.ref_enc(y, mask=mask).unsqueeze(-1)
+            for j, i in enumerate(bucket):
+                gs[i] = g[j:j + 1].detach().float()
+        return torch.stack(gs)
 
-        return gs
+    def convert_batch(self, audio_src_list, src_se, tgt_se, tau=0.3, message="default", batch_size=8, max_ratio=None,
+                      sr=None):
+        """
+        audio_src_list: list of paths or waveforms (NumPy arrays / torch tensors sampled at sr)
+        src_se, tgt_se: one embedding shared by all clips, or a list with one per clip
+        Clips are grouped into length buckets of at most batch_size, each bucket is
+        only padded to its own longest clip and converted in a single forward pass.
+        """
+        device = self.device
+        timer = pipeline.StageTimer()
+        specs = []
+        for audio_src in audio_src_list:
+            y = self._load_audio(audio_src, sr=sr).to(device).unsqueeze(0)
+            specs.append(self.spectrogram(y))
+        spec_lengths = [spec.size(-1) for spec in specs]
 
-    def convert(self, audio_src_path, src_se, tgt_se, output_path=None, tau=0.3, message="default"):
+        audios = [None] * len(specs)
+        for bucket in commons.bucket_by_length(spec_lengths, batch_size, max_ratio=max_ratio):
+            spec = torch.zeros(len(bucket), specs[0].size(1), max(spec_lengths[i] for i in bucket), device=device)
+            for j, i in enumerate(bucket):
+                spec[j, :, :spec_lengths[i]] = specs[i][0]
+            with timer.stage('conversion'), self.inference_context():
+                lengths = torch.LongTensor([spec_lengths[i] for i in bucket]).to(device)
+                o_hat, y_mask, _ = self.model.voice_conversion(spec, lengths, sid_src=self._stack_se(src_se, bucket),
+                                                               sid_tgt=self._stack_se(tgt_se, bucket), tau=tau)
+                hop_length = o_hat.size(-1) // y_mask.size(-1)
+                o_hat = o_hat[:, 0].data.cpu().float().numpy()
+            with timer.stage('watermark'):
+                for j, i in enumerate(bucket):
+                    audios[i] = self.add_watermark(o_hat[j, :spec_lengths[i] * hop_length], message)
+        self.last_timings = timer.summary()
+        return audios
+
+    def _stack_se(self, se, indices):
+        if isinstance(se, (list, tuple)):
+            return torch.cat([se[i] for i in indices], dim=0).to(self.device)
+        return se.to(self.device).expand(len(indices), -1, -1)
+
+    def _load_audio(self, audio, sr=None):
+        # file path, NumPy array or torch tensor -> mono float waveform at the model's sampling rate
+        target_sr = self.hps.data.sampling_rate
+        if isinstance(audio, str):
+            audio, _ = librosa.load(audio, sr=target_sr)
+            return torch.FloatTensor(audio)
+        if torch.is_tensor(audio):
+            audio = audio.detach().float()
+        else:
+            audio = torch.from_numpy(np.asarray(audio, dtype=np.float32))
+        audio = audio.squeeze()
+        if audio.dim() == 2:
+            # multi-channel input is downmixed like librosa.load(mono=True) does for files, the channel
+            # axis is the short one: [n, channels] from soundfile.read or [channels, n] from torchaudio
+            audio = audio.mean(dim=int(audio.size(0) > audio.size(1)))
+        assert audio.dim() <= 1, f"expected a mono or multi-channel waveform, got shape {tuple(audio.shape)}"
+        audio = audio.reshape(-1)
+        if sr is not None and sr != target_sr:
+            audio = torch.from_numpy(librosa.resample(audio.cpu().numpy(), orig_sr=sr, target_sr=target_sr))
+        return audio
+
+    def convert(self, audio_src_path, src_se, tgt_se, output_path=None, tau=0.3, message="default", sr=None,
+                async_watermark=False):
+        """
+        audio_src_path: path of the source audio, or its waveform (NumPy array / torch tensor) sampled at sr
+        message: the watermark message, None to leave the output unwatermarked
+        async_watermark: watermark (and write output_path) in the watermark pool, a Future of the usual
+        return value is returned as soon as the conversion itself is done
+        The time spent in conversion and watermarking is reported separately in last_timings.
+        """
         hps = self.hps
+        timer = pipeline.StageTimer()
         # load audio
-        audio, sample_rate = librosa.load(audio_src_path, sr=hps.data.sampling_rate)
-        audio = torch.tensor(audio).float()
+        audio = self._load_audio(audio_src_path, sr=sr)
         
-        with torch.no_grad():
-            y = torch.FloatTensor(audio).to(self.device)
+        with timer.stage('conversion'), self.inference_context():
+            y = audio.to(self.device)
             y = y.unsqueeze(0)
-            spec = spectrogram_torch(y, hps.data.filter_length,
-                                    hps.data.sampling_rate, hps.data.hop_length, hps.data.win_length,
-                                    center=False).to(self.device)
+            spec = self.spectrogram(y)
             spec_lengths = torch.LongTensor([spec.size(-1)]).to(self.device)
             audio = self.model.voice_conversion(spec, spec_lengths, sid_src=src_se, sid_tgt=tgt_se, tau=tau)[0][
                         0, 0].data.cpu().float().numpy()
-            audio = self.add_watermark(audio, message)
+        self.last_timings = timer.summary()
+
+        def postprocess():
+            with timer.stage('watermark'):
+                wmd_audio = self.add_watermark(audio, message)
+            self.last_timings = timer.summary()
             if output_path is None:
-                return audio
+                return wmd_audio
             else:
-                soundfile.write(output_path, audio, hps.data.sampling_rate)
+                soundfile.write(output_path, wmd_audio, hps.data.sampling_rate)
+
+        if async_watermark:
+            return watermark.get_watermark_executor().submit(postprocess)
+        return postprocess()
     
     def add_watermark(self, audio, message):
-        if self.watermark_model is None:
+        if self.watermark_model is None or message is None:
             return audio
         device = self.device
         bits = utils.string_to_bits(message).reshape(-1)
         n_repeat = len(bits) // 32
 
-        K = 16000
-        coeff = 2
-        for n in range(n_repeat):
-            trunck = audio[(coeff * n) * K: (coeff * n + 1) * K]
-            if len(trunck) != K:
-                print('Audio too short, fail to add watermark')
-                break
-            message_npy = bits[n * 32: (n + 1) * 32]
-            
-            with torch.no_grad():
-                signal = torch.FloatTensor(trunck).to(device)[None]
-                message_tensor = torch.FloatTensor(message_npy).to(device)[None]
-                signal_wmd_tensor = self.watermark_model.encode(signal, message_tensor)
-                signal_wmd_npy = signal_wmd_tensor.detach().cpu().squeeze()
-            audio[(coeff * n) * K: (coeff * n + 1) * K] = signal_wmd_npy
+        # every chunk that fits is watermarked in a single batched encode call
+        index = watermark.chunk_index(len(audio), n_repeat)
+        n_chunks = len(index)
+        if n_chunks < n_repeat:
+            print('Audio too short, fail to add watermark')
+        if n_chunks == 0:
+            return audio
+
+        audio[index] = watermark.encode_chunks(self.watermark_model, audio[index],
+                                               bits[:n_chunks * 32].reshape(n_chunks, 32), device)
         return audio
 
-    def detect_watermark(self, audio, n_repeat):
-        bits = []
-        K = 16000
-        coeff = 2
-        for n in range(n_repeat):
-            trunck = audio[(coeff * n) * K: (coeff * n + 1) * K]
-            if len(trunck) != K:
-                print('Audio too short, fail to detect watermark')
-                return 'Fail'
-            with torch.no_grad():
-                signal = torch.FloatTensor(trunck).to(self.device).unsqueeze(0)
-                message_decoded_npy = (self.watermark_model.decode(signal) >= 0.5).int().detach().cpu().numpy().squeeze()
-            bits.append(message_decoded_npy)
-        bits = np.stack(bits).reshape(-1, 8)
-        message = utils.bits_to_string(bits)
-        return message
+    def watermark_stream(self, message="default"):
+        """
+        A watermark.StreamWatermarker for output converted piece by piece with message=None, so the
+        stream carries the watermark the same way the whole clip would.
+        """
+        return watermark.StreamWatermarker(self.watermark_model, message, self.device)
+
+    def detect_watermark(self, audio, n_repeat=None, return_confidence=False):
+        """
+        Decode the message from all its chunks in one forward pass.
+        n_repeat defaults to the number of chunks add_watermark writes for a message.
+        With return_confidence, a (message, confidence) tuple is returned, see watermark.decoded_to_message.
+        """
+        n_repeat = watermark.default_n_repeat() if n_repeat is None else n_repeat
+        if torch.is_tensor(audio):
+            audio = audio.detach().cpu().numpy()
+        index = watermark.chunk_index(len(audio), n_repeat)
+        if len(index) < n_repeat:
+            print('Audio too short, fail to detect watermark')
+            return ('Fail', 0.) if return_confidence else 'Fail'
+        decoded = watermark.decode_chunks(self.watermark_model, audio[index], self.device)
+        message, confidence = watermark.decoded_to_message(decoded)
+        return (message, confidence) if return_confidence else message
+
+    def scan_watermarks(self, sources, n_repeat=None, workers=4, batch_size=16):
+        """Bulk detection over a directory or a list of files / waveforms, see watermark.scan_watermarks."""
+        return watermark.scan_watermarks(self.watermark_model, sources, device=self.device, n_repeat=n_repeat,
+                                         workers=workers, batch_size=batch_size)
     
+
+
+class OnnxToneColorConverter(ToneColorConverter):
+    """
+    ToneColorConverter backed by the ONNX graphs written by openvoice.onnx_export, run with onnxruntime.
+    All other methods (extract_se, convert, convert_batch, watermarking) are the same.
+    intra_op_threads / inter_op_threads: onnxruntime thread pools, 0 lets onnxruntime decide
+    """
+
+    def __init__(self, config_path, onnx_dir, intra_op_threads=0, inter_op_threads=0,
+                 providers=('CPUExecutionProvider',), **kwargs):
+        self.onnx_dir = onnx_dir
+        self.intra_op_threads = intra_op_threads
+        self.inter_op_threads = inter_op_threads
+        self.providers = list(providers)
+        kwargs.setdefault('device', 'cpu')
+        super().__init__(config_path, **kwargs)
+
+    def build_model(self, hps, device):
+        from openvoice.onnx_export import OnnxSynthesizer
+        return OnnxSynthesizer(self.onnx_dir, zero_g=getattr(hps.model, 'zero_g', False),
+                               intra_op_threads=self.intra_op_threads, inter_op_threads=self.inter_op_threads,
+                               providers=self.providers)
+
+    def load_ckpt(self, ckpt_path):
+        print("The weights are part of the ONNX graphs, '{}' is not loaded".format(ckpt_path))
@@ -0,0 +1,114 @@
+import time
+import queue
+import threading
+from concurrent.futures import Future
+
+
+class _ConversionRequest(object):
+    def __init__(self, audio, src_se, tgt_se, tau, message):
+        self.audio = audio
+        self.src_se = src_se
+        self.tgt_se = tgt_se
+        self.tau = tau
+        self.message = message
+        self.future = Future()
+        self.enqueued = time.perf_counter()
+
+
+class ConversionScheduler(object):
+    """
+    Dynamic micro-batching in front of a ToneColorConverter.
+    Concurrent requests are collected for up to max_wait_ms or max_batch_size items,
+    grouped by target embedding, tau and watermark message, and every group is run through
+    convert_batch, which buckets the clips by length. Results are scattered back to the
+    waiting callers through futures.
+    """
+
+    def __init__(self, converter, max_batch_size=8, max_wait_ms=5, max_ratio=1.5):
+        self.converter = converter
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.
+        self.max_ratio = max_ratio
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.batches = 0
+        self.items = 0
+        self.max_batch = 0
+        self.total_wait = 0.
+        self.max_wait_seen = 0.
+        self.total_compute = 0.
+        self.thread = threading.Thread(target=self._run, name='openvoice-batching', daemon=True)
+        self.thread.start()
+
+    def submit(self, audio, src_se, tgt_se, tau=0.3, message="default", sr=None):
+        # decoding and resampling happen in the caller's thread, the worker only runs the model
+        audio = self.converter._load_audio(audio, sr=sr)
+        request = _ConversionRequest(audio, src_se, tgt_se, tau, message)
+        self.queue.put(request)
+        return request.future
+
+    def convert(self, audio, src_se, tgt_se, tau=0.3, message="default", sr=None, timeout=None):
+        return self.submit(audio, src_se, tgt_se, tau=tau, message=message, sr=sr).result(timeout=timeout)
+
+    def _run(self):
+        while True:
+            first = self.queue.get()
+            batch = [first]
+            deadline = first.enqueued + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - time.perf_counter()
+                try:
+                    if timeout > 0:
+                        batch.append(self.queue.get(timeout=timeout))
+                    else:
+                        batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            self._run_batch(batch)
+
+    def _run_batch(self, batch):
+        groups = {}
+        for request in batch:
+            key = (id(request.tgt_se), request.tau, request.message)
+            groups.setdefault(key, []).append(request)
+
+        for requests in groups.values():
+            start = time.perf_counter()
+            try:
+                audios = self.converter.convert_batch(
+                    [r.audio for r in requests],
+                    [r.src_se for r in requests],
+                    requests[0].tgt_se,
+                    tau=requests[0].tau,
+                    message=requests[0].message,
+                    batch_size=self.max_batch_size,
+                    max_ratio=self.max_ratio)
+            except Exception as e:
+                for r in requests:
+                    r.future.set_exception(e)
+                continue
+            end = time.perf_counter()
+
+            with self.lock:
+                self.batches += 1
+                self.items += len(requests)
+                self.max_batch = max(self.max_batch, len(requests))
+                for r in requests:
+                    self.total_wait += start - r.enqueued
+                    self.max_wait_seen = max(self.max_wait_seen, start - r.enqueued)
+                self.total_compute += end - start
+            for r, audio in zip(requests, audios):
+                r.future.set_result(audio)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'queue_depth': self.queue.qsize(),
+                'batches': self.batches,
+                'items': self.items,
+                'mean_batch_size': self.items / max(self.batches, 1),
+                'max_batch_size': self.max_batch,
+                'mean_wait_ms': 1000 * self.total_wait / max(self.items, 1),
+                'max_wait_ms': 1000 * self.max_wait_seen,
+                'mean_batch_compute_ms': 1000 * self.total_compute / max(self.batches, 1),
+            }
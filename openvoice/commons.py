@@ -125,6 +125,26 @@ def sequence_mask(length, max_length=None):
     return x.unsqueeze(0) < length.unsqueeze(1)
 
 
+def bucket_by_length(lengths, batch_size, max_ratio=None):
+    """
+    Group item indices into buckets of at most batch_size items of similar length,
+    so that each bucket is only padded to its own longest item.
+    max_ratio: start a new bucket once longest / shortest would exceed it
+    """
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i])
+    buckets = []
+    bucket = []
+    for i in order:
+        if len(bucket) > 0 and (len(bucket) >= batch_size or
+                                (max_ratio is not None and lengths[i] > max_ratio * max(lengths[bucket[0]], 1))):
+            buckets.append(bucket)
+            bucket = []
+        bucket.append(i)
+    if len(bucket) > 0:
+        buckets.append(bucket)
+    return buckets
+
+
 def generate_path(duration, mask):
     """
     duration: [b, 1, t_x]
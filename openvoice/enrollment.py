@@ -0,0 +1,85 @@
+import os
+import torch
+import numpy as np
+
+
+class SpeakerEnrollment(object):
+    """
+    Incrementally enrolled tone color of one speaker.
+    Only the running sum and count of segment embeddings are kept, so adding audio costs one
+    reference encoder pass over the new audio, and the current embedding (sum / count) is the
+    same mean extract_se computes over all segments at once.
+    Streaming audio is buffered until it forms a segment of segment_seconds.
+    """
+
+    def __init__(self, vc_model, segment_seconds=10.0, min_segment_seconds=1.5):
+        self.vc_model = vc_model
+        self.sampling_rate = vc_model.hps.data.sampling_rate
+        self.segment_samples = int(segment_seconds * self.sampling_rate)
+        self.min_segment_samples = int(min_segment_seconds * self.sampling_rate)
+        self.se_sum = None
+        self.count = 0
+        self.buffer = np.zeros(0, dtype=np.float32)
+
+    def add_audio(self, audio, sr=None):
+        """Append a chunk of a live stream, every full segment in the buffer is embedded right away."""
+        audio = self.vc_model._load_audio(audio, sr=sr).cpu().numpy()
+        self.buffer = np.concatenate([self.buffer, audio])
+        n_segments = len(self.buffer) // self.segment_samples
+        if n_segments > 0:
+            end = n_segments * self.segment_samples
+            self.add_segments(np.split(self.buffer[:end], n_segments))
+            self.buffer = self.buffer[end:]
+        return self
+
+    def add_segments(self, segments, sr=None):
+        """Add already segmented audio (paths or waveforms), e.g. the output of split_audio_vad_arrays."""
+        if not isinstance(segments, (list, tuple)):
+            segments = [segments]
+        if len(segments) == 0:
+            return self
+        gs = self.vc_model.embed_segments(segments, sr=sr).cpu()
+        se_sum = gs.sum(0)
+        self.se_sum = se_sum if self.se_sum is None else self.se_sum + se_sum
+        self.count += gs.size(0)
+        return self
+
+    def flush(self):
+        """Embed what is left in the buffer, if it is long enough to be a segment."""
+        if len(self.buffer) >= self.min_segment_samples:
+            self.add_segments([self.buffer])
+        self.buffer = np.zeros(0, dtype=np.float32)
+        return self
+
+    @property
+    def embedding(self):
+        if self.count == 0:
+            return None
+        return (self.se_sum / self.count).to(self.vc_model.device)
+
+    def state_dict(self):
+        # the unembedded buffer is not persisted, only the O(1) running statistics
+        return {
+            'se_sum': None if self.se_sum is None else self.se_sum.clone(),
+            'count': self.count,
+            'version': self.vc_model.version,
+        }
+
+    def load_state_dict(self, state):
+        assert state['version'] == self.vc_model.version, \
+            f"profile was enrolled with OpenVoice {state['version']}, the model is {self.vc_model.version}"
+        self.se_sum = state['se_sum']
+        self.count = state['count']
+        return self
+
+    def save(self, path):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        torch.save(self.state_dict(), path)
+
+    @classmethod
+    def load(cls, path, vc_model, **kwargs):
+        enrollment = cls(vc_model, **kwargs)
+        if os.path.isfile(path):
+            enrollment.load_state_dict(torch.load(path, map_location='cpu'))
+        return enrollment
@@ -1,5 +1,6 @@
 import torch
 import torch.utils.data
+import librosa
 from librosa.filters import mel as librosa_mel_fn
 
 MAX_WAV_VALUE = 32768.0
@@ -35,21 +36,56 @@ def spectral_de_normalize_torch(magnitudes):
 
 mel_basis = {}
 hann_window = {}
+conv_basis = {}
 
 
-def spectrogram_torch(y, n_fft, sampling_rate, hop_size, win_size, center=False):
-    if torch.min(y) < -1.1:
-        print("min value is ", torch.min(y))
-    if torch.max(y) > 1.1:
-        print("max value is ", torch.max(y))
+def check_wav_range(y, limit):
+    # one pass over the signal for both bounds, only to warn about clipped input
+    min_value, max_value = torch.aminmax(y)
+    if min_value < -limit:
+        print("min value is ", min_value)
+    if max_value > limit:
+        print("max value is ", max_value)
 
-    global hann_window
-    dtype_device = str(y.dtype) + "_" + str(y.device)
-    wnsize_dtype_device = str(win_size) + "_" + dtype_device
-    if wnsize_dtype_device not in hann_window:
-        hann_window[wnsize_dtype_device] = torch.hann_window(win_size).to(
-            dtype=y.dtype, device=y.device
-        )
+
+def get_hann_window(win_size, dtype, device):
+    key = (win_size, dtype, device)
+    if key not in hann_window:
+        hann_window[key] = torch.hann_window(win_size).to(dtype=dtype, device=device)
+    return hann_window[key]
+
+
+def get_mel_basis(sampling_rate, n_fft, num_mels, fmin, fmax, dtype, device):
+    key = (sampling_rate, n_fft, num_mels, fmin, fmax, dtype, device)
+    if key not in mel_basis:
+        mel = librosa_mel_fn(sr=sampling_rate, n_fft=n_fft, n_mels=num_mels, fmin=fmin, fmax=fmax)
+        mel_basis[key] = torch.from_numpy(mel).to(dtype=dtype, device=device)
+    return mel_basis[key]
+
+
+def get_conv_basis(n_fft, win_size, dtype, device):
+    """Windowed real and imaginary DFT rows as conv1d weights, [2 * (n_fft // 2 + 1), 1, n_fft]."""
+    key = (n_fft, win_size, dtype, device)
+    if key not in conv_basis:
+        freq_cutoff = n_fft // 2 + 1
+        fourier_basis = torch.view_as_real(torch.fft.fft(torch.eye(n_fft)))
+        forward_basis = fourier_basis[:freq_cutoff].permute(2, 0, 1).reshape(-1, 1, fourier_basis.shape[1])
+        forward_basis = forward_basis * torch.as_tensor(
+            librosa.util.pad_center(torch.hann_window(win_size).numpy(), size=n_fft)).float()
+        conv_basis[key] = forward_basis.to(dtype=dtype, device=device)
+    return conv_basis[key]
+
+
+def spectrogram_torch(y, n_fft, sampling_rate, hop_size, win_size, center=False, check_range=True):
+    with torch.autocast(device_type=y.device.type, enabled=False):
+        return _spectrogram_torch(y, n_fft, hop_size, win_size, center, check_range)
+
+
+def _spectrogram_torch(y, n_fft, hop_size, win_size, center, check_range):
+    if check_range:
+        check_wav_range(y, 1.1)
+
+    window = get_hann_window(win_size, y.dtype, y.device)
 
     y = torch.nn.functional.pad(
         y.unsqueeze(1),
@@ -63,121 +99,126 @@ def spectrogram_torch(y, n_fft, sampling_rate, hop_size, win_size, center=False)
         n_fft,
         hop_length=hop_size,
         win_length=win_size,
-        window=hann_window[wnsize_dtype_device],
+        window=window,
         center=center,
         pad_mode="reflect",
         normalized=False,
         onesided=True,
-        return_complex=False,
+        return_complex=True,
     )
+    spec = torch.view_as_real(spec)
 
     spec = torch.sqrt(spec.pow(2).sum(-1) + 1e-6)
     return spec
 
 
 def spectrogram_torch_conv(y, n_fft, sampling_rate, hop_size, win_size, center=False):
-    # if torch.min(y) < -1.:
-    #     print('min value is ', torch.min(y))
-    # if torch.max(y) > 1.:
-    #     print('max value is ', torch.max(y))
-
-    global hann_window
-    dtype_device = str(y.dtype) + '_' + str(y.device)
-    wnsize_dtype_device = str(win_size) + '_' + dtype_device
-    if wnsize_dtype_device not in hann_window:
-        hann_window[wnsize_dtype_device] = torch.hann_window(win_size).to(dtype=y.dtype, device=y.device)
+    # STFT as a strided conv1d with a cached DFT basis, matches spectrogram_torch to ~1e-4
+    assert center is False, "the conv STFT only supports center=False"
 
     y = torch.nn.functional.pad(y.unsqueeze(1), (int((n_fft-hop_size)/2), int((n_fft-hop_size)/2)), mode='reflect')
-    
-    # ******************** original ************************#
-    # y = y.squeeze(1)
-    # spec1 = torch.stft(y, n_fft, hop_length=hop_size, win_length=win_size, window=hann_window[wnsize_dtype_device],
-    #                   center=center, pad_mode='reflect', normalized=False, onesided=True, return_complex=False)
 
-    # ******************** ConvSTFT ************************#
     freq_cutoff = n_fft // 2 + 1
-    fourier_basis = torch.view_as_real(torch.fft.fft(torch.eye(n_fft)))
-    forward_basis = fourier_basis[:freq_cutoff].permute(2, 0, 1).reshape(-1, 1, fourier_basis.shape[1])
-    forward_basis = forward_basis * torch.as_tensor(librosa.util.pad_center(torch.hann_window(win_size), size=n_fft)).float()
-
-    import torch.nn.functional as F
-
-    # if center:
-    #     signal = F.pad(y[:, None, None, :], (n_fft // 2, n_fft // 2, 0, 0), mode = 'reflect').squeeze(1)
-    assert center is False
-
-    forward_transform_squared = F.conv1d(y, forward_basis.to(y.device), stride = hop_size)
-    spec2 = torch.stack([forward_transform_squared[:, :freq_cutoff, :], forward_transform_squared[:, freq_cutoff:, :]], dim = -1)
-
-
-    # ******************** Verification ************************#
-    spec1 = torch.stft(y.squeeze(1), n_fft, hop_length=hop_size, win_length=win_size, window=hann_window[wnsize_dtype_device],
-                      center=center, pad_mode='reflect', normalized=False, onesided=True, return_complex=False)
-    assert torch.allclose(spec1, spec2, atol=1e-4)
-
-    spec = torch.sqrt(spec2.pow(2).sum(-1) + 1e-6)
+    with torch.autocast(device_type=y.device.type, enabled=False):
+        forward_transform = torch.nn.functional.conv1d(y, get_conv_basis(n_fft, win_size, y.dtype, y.device),
+                                                       stride=hop_size)
+    spec = forward_transform[:, :freq_cutoff, :].pow(2) + forward_transform[:, freq_cutoff:, :].pow(2)
+    spec = torch.sqrt(spec + 1e-6)
     return spec
 
 
 def spec_to_mel_torch(spec, n_fft, num_mels, sampling_rate, fmin, fmax):
-    global mel_basis
-    dtype_device = str(spec.dtype) + "_" + str(spec.device)
-    fmax_dtype_device = str(fmax) + "_" + dtype_device
-    if fmax_dtype_device not in mel_basis:
-        mel = librosa_mel_fn(sampling_rate, n_fft, num_mels, fmin, fmax)
-        mel_basis[fmax_dtype_device] = torch.from_numpy(mel).to(
-            dtype=spec.dtype, device=spec.device
-        )
-    spec = torch.matmul(mel_basis[fmax_dtype_device], spec)
+    basis = get_mel_basis(sampling_rate, n_fft, num_mels, fmin, fmax, spec.dtype, spec.device)
+    spec = torch.matmul(basis, spec)
     spec = spectral_normalize_torch(spec)
     return spec
 
 
 def mel_spectrogram_torch(
-    y, n_fft, num_mels, sampling_rate, hop_size, win_size, fmin, fmax, center=False
+    y, n_fft, num_mels, sampling_rate, hop_size, win_size, fmin, fmax, center=False, check_range=True
 ):
-    if torch.min(y) < -1.0:
-        print("min value is ", torch.min(y))
-    if torch.max(y) > 1.0:
-        print("max value is ", torch.max(y))
-
-    global mel_basis, hann_window
-    dtype_device = str(y.dtype) + "_" + str(y.device)
-    fmax_dtype_device = str(fmax) + "_" + dtype_device
-    wnsize_dtype_device = str(win_size) + "_" + dtype_device
-    if fmax_dtype_device not in mel_basis:
-        mel = librosa_mel_fn(sampling_rate, n_fft, num_mels, fmin, fmax)
-        mel_basis[fmax_dtype_device] = torch.from_numpy(mel).to(
-            dtype=y.dtype, device=y.device
-        )
-    if wnsize_dtype_device not in hann_window:
-        hann_window[wnsize_dtype_device] = torch.hann_window(win_size).to(
-            dtype=y.dtype, device=y.device
-        )
-
-    y = torch.nn.functional.pad(
-        y.unsqueeze(1),
-        (int((n_fft - hop_size) / 2), int((n_fft - hop_size) / 2)),
-        mode="reflect",
-    )
-    y = y.squeeze(1)
+    if check_range:
+        check_wav_range(y, 1.0)
 
-    spec = torch.stft(
-        y,
-        n_fft,
-        hop_length=hop_size,
-        win_length=win_size,
-        window=hann_window[wnsize_dtype_device],
-        center=center,
-        pad_mode="reflect",
-        normalized=False,
-        onesided=True,
-        return_complex=False,
-    )
+    spec = spectrogram_torch(y, n_fft, sampling_rate, hop_size, win_size, center=center, check_range=False)
+    return spec_to_mel_torch(spec, n_fft, num_mels, sampling_rate, fmin, fmax)
 
-    spec = torch.sqrt(spec.pow(2).sum(-1) + 1e-6)
 
-    spec = torch.matmul(mel_basis[fmax_dtype_device], spec)
-    spec = spectral_normalize_torch(spec)
+class SpectrogramExtractor(object):
+    """
+    Linear / mel spectrograms with fixed STFT parameters.
+    Windows, mel filterbanks and conv bases are built once per (dtype, device) and kept on the
+    object, so a call is only the padding, the STFT and the magnitude. Range checks are off by default.
+    """
 
-    return spec
\ No newline at end of file
+    def __init__(self, n_fft, hop_size, win_size, sampling_rate=None, num_mels=None, fmin=0.0, fmax=None,
+                 center=False, check_range=False, use_conv=False):
+        self.n_fft = n_fft
+        self.hop_size = hop_size
+        self.win_size = win_size
+        self.sampling_rate = sampling_rate
+        self.num_mels = num_mels
+        self.fmin = fmin
+        self.fmax = fmax
+        self.center = center
+        self.check_range = check_range
+        self.use_conv = use_conv
+        self.padding = int((n_fft - hop_size) / 2)
+        self.windows = {}
+        self.mel_bases = {}
+        self.conv_bases = {}
+
+    @classmethod
+    def from_hparams(cls, data, **kwargs):
+        """From the `data` section of a config, e.g. hps.data."""
+        return cls(data.filter_length, data.hop_length, data.win_length, sampling_rate=data.sampling_rate,
+                   num_mels=getattr(data, 'n_mel_channels', None), fmin=getattr(data, 'mel_fmin', 0.0),
+                   fmax=getattr(data, 'mel_fmax', None), **kwargs)
+
+    def window(self, dtype, device):
+        key = (dtype, device)
+        if key not in self.windows:
+            self.windows[key] = get_hann_window(self.win_size, dtype, device)
+        return self.windows[key]
+
+    def mel_basis(self, dtype, device):
+        key = (dtype, device)
+        if key not in self.mel_bases:
+            self.mel_bases[key] = get_mel_basis(self.sampling_rate, self.n_fft, self.num_mels, self.fmin, self.fmax,
+                                                dtype, device)
+        return self.mel_bases[key]
+
+    def conv_basis(self, dtype, device):
+        key = (dtype, device)
+        if key not in self.conv_bases:
+            self.conv_bases[key] = get_conv_basis(self.n_fft, self.win_size, dtype, device)
+        return self.conv_bases[key]
+
+    def spectrogram(self, y):
+        """y: [B, T] waveform -> [B, n_fft // 2 + 1, frames] magnitude, same as spectrogram_torch."""
+        # the STFT and its magnitude stay in the input precision under autocast
+        with torch.autocast(device_type=y.device.type, enabled=False):
+            return self._spectrogram(y)
+
+    def _spectrogram(self, y):
+        if self.check_range:
+            check_wav_range(y, 1.1)
+        y = torch.nn.functional.pad(y.unsqueeze(1), (self.padding, self.padding), mode="reflect")
+        if self.use_conv and not self.center:
+            freq_cutoff = self.n_fft // 2 + 1
+            forward_transform = torch.nn.functional.conv1d(y, self.conv_basis(y.dtype, y.device), stride=self.hop_size)
+            spec = forward_transform[:, :freq_cutoff, :].pow(2) + forward_transform[:, freq_cutoff:, :].pow(2)
+            return torch.sqrt(spec + 1e-6)
+
+        spec = torch.stft(y.squeeze(1), self.n_fft, hop_length=self.hop_size, win_length=self.win_size,
+                          window=self.window(y.dtype, y.device), center=self.center, pad_mode="reflect",
+                          normalized=False, onesided=True, return_complex=True)
+        spec = torch.view_as_real(spec)
+        return torch.sqrt(spec.pow(2).sum(-1) + 1e-6)
+
+    def mel(self, y):
+        spec = self.spectrogram(y)
+        spec = torch.matmul(self.mel_basis(spec.dtype, spec.device), spec)
+        return spectral_normalize_torch(spec)
+
+    __call__ = spectrogram
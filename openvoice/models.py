@@ -215,11 +215,15 @@ class PosteriorEncoder(nn.Module):
         )
         x = self.pre(x) * x_mask
         x = self.enc(x, x_mask, g=g)
-        stats = self.proj(x) * x_mask
+        # exp(logs) stays in fp32 under reduced precision autocast
+        stats = self.proj(x).float() * x_mask
         m, logs = torch.split(stats, self.out_channels, dim=1)
         z = (m + torch.randn_like(m) * tau * torch.exp(logs)) * x_mask
         return z, m, logs, x_mask
 
+    def remove_weight_norm(self):
+        self.enc.remove_weight_norm()
+
 
 class Generator(torch.nn.Module):
     def __init__(
@@ -269,20 +273,29 @@ class Generator(torch.nn.Module):
         if gin_channels != 0:
             self.cond = nn.Conv1d(gin_channels, upsample_initial_channel, 1)
 
-    def forward(self, x, g=None):
+    def forward(self, x, g=None, x_mask=None):
+        # x_mask is only needed for padded batches, it keeps the padded frames at zero
+        # so that every item decodes exactly as it would on its own
         x = self.conv_pre(x)
         if g is not None:
             x = x + self.cond(g)
+        if x_mask is not None:
+            x = x * x_mask
 
         for i in range(self.num_upsamples):
             x = F.leaky_relu(x, modules.LRELU_SLOPE)
             x = self.ups[i](x)
+            if x_mask is not None:
+                # nearest upsampling of the mask, expand + reshape also exports to cheap ONNX ops
+                x_mask = x_mask.unsqueeze(-1).expand(-1, -1, -1, x.size(2) // x_mask.size(2)).reshape(
+                    x_mask.size(0), 1, x.size(2))
+                x = x * x_mask
             xs = None
             for j in range(self.num_kernels):
                 if xs is None:
-                    xs = self.resblocks[i * self.num_kernels + j](x)
+                    xs = self.resblocks[i * self.num_kernels + j](x, x_mask)
                 else:
-                    xs += self.resblocks[i * self.num_kernels + j](x)
+                    xs += self.resblocks[i * self.num_kernels + j](x, x_mask)
             x = xs / self.num_kernels
         x = F.leaky_relu(x)
         x = self.conv_post(x)
@@ -337,27 +350,46 @@ class ReferenceEncoder(nn.Module):
             self.layernorm = None
 
     def forward(self, inputs, mask=None):
+        """
+        mask --- [N, Ty], marks the valid frames of a padded batch. Padded frames are zeroed
+        before every conv and skipped by the GRU, so each item encodes as it would on its own.
+        """
         N = inputs.size(0)
 
         out = inputs.view(N, 1, -1, self.spec_channels)  # [N, 1, Ty, n_freqs]
         if self.layernorm is not None:
             out = self.layernorm(out)
 
+        lengths = None
+        if mask is not None:
+            lengths = mask.sum(-1).long()
+
         for conv in self.convs:
+            if lengths is not None:
+                out = out * commons.sequence_mask(lengths, out.size(2))[:, None, :, None].to(out.dtype)
             out = conv(out)
             # out = wn(out)
             out = F.relu(out)  # [N, 128, Ty//2^K, n_mels//2^K]
+            if lengths is not None:
+                lengths = self.calculate_channels(lengths, 3, 2, 1, 1)
 
         out = out.transpose(1, 2)  # [N, Ty//2^K, 128, n_mels//2^K]
         T = out.size(1)
         N = out.size(0)
         out = out.contiguous().view(N, T, -1)  # [N, Ty//2^K, 128*n_mels//2^K]
 
-        self.gru.flatten_parameters()
+        if hasattr(self.gru, 'flatten_parameters'):  # not on a quantized GRU
+            self.gru.flatten_parameters()
+        if lengths is not None:
+            out = nn.utils.rnn.pack_padded_sequence(out, lengths.cpu(), batch_first=True, enforce_sorted=False)
         memory, out = self.gru(out)  # out --- [1, N, 128]
 
         return self.proj(out.squeeze(0))
 
+    def remove_weight_norm(self):
+        for conv in self.convs:
+            remove_weight_norm(conv)
+
     def calculate_channels(self, L, kernel_size, stride, pad, n_convs):
         for i in range(n_convs):
             L = (L - kernel_size + 2 * pad) // stride + 1
@@ -396,6 +428,11 @@ class ResidualCouplingBlock(nn.Module):
                 x = flow(x, x_mask, g=g, reverse=reverse)
         return x
 
+    def remove_weight_norm(self):
+        for flow in self.flows:
+            if isinstance(flow, modules.ResidualCouplingLayer):
+                flow.remove_weight_norm()
+
 class SynthesizerTrn(nn.Module):
     """
     Synthesizer for Training
@@ -463,6 +500,9 @@ class SynthesizerTrn(nn.Module):
             self.dp = DurationPredictor(hidden_channels, 256, 3, 0.5, gin_channels=gin_channels)
             self.emb_g = nn.Embedding(n_speakers, gin_channels)
         self.zero_g = zero_g
+        # TorchScript versions of the entry points, see openvoice.torchscript. A plain dict,
+        # so they are not registered as submodules and stay out of the state dict
+        self.compiled = {}
 
     def infer(self, x, x_lengths, sid=None, noise_scale=1, length_scale=1, noise_scale_w=1., sdp_ratio=0.2, max_len=None):
         x, m_p, logs_p, x_mask = self.enc_p(x, x_lengths)
@@ -485,15 +525,32 @@ class SynthesizerTrn(nn.Module):
         logs_p = torch.matmul(attn.squeeze(1), logs_p.transpose(1, 2)).transpose(1, 2) # [b, t', t], [b, t, d] -> [b, d, t']
 
         z_p = m_p + torch.randn_like(m_p) * torch.exp(logs_p) * noise_scale
+        if 'flow_decoder' in self.compiled and x.size(0) == 1 and max_len is None:
+            o, z = self.compiled['flow_decoder'](z_p, y_mask, g)
+            return o, attn, y_mask, (z, z_p, m_p, logs_p)
         z = self.flow(z_p, y_mask, g=g, reverse=True)
-        o = self.dec((z * y_mask)[:,:,:max_len], g=g)
+        o = self.dec((z * y_mask)[:,:,:max_len], g=g, x_mask=y_mask[:,:,:max_len] if x.size(0) > 1 else None)
         return o, attn, y_mask, (z, z_p, m_p, logs_p)
 
     def voice_conversion(self, y, y_lengths, sid_src, sid_tgt, tau=1.0):
+        if 'voice_conversion' in self.compiled and y.size(0) == 1:
+            tau = torch.tensor(float(tau), device=y.device)
+            o_hat, y_mask, z, z_p, z_hat = self.compiled['voice_conversion'](y, y_lengths, sid_src, sid_tgt, tau)
+            return o_hat, y_mask, (z, z_p, z_hat)
         g_src = sid_src
         g_tgt = sid_tgt
         z, m_q, logs_q, y_mask = self.enc_q(y, y_lengths, g=g_src if not self.zero_g else torch.zeros_like(g_src), tau=tau)
         z_p = self.flow(z, y_mask, g=g_src)
         z_hat = self.flow(z_p, y_mask, g=g_tgt, reverse=True)
-        o_hat = self.dec(z_hat * y_mask, g=g_tgt if not self.zero_g else torch.zeros_like(g_tgt))
+        o_hat = self.dec(z_hat * y_mask, g=g_tgt if not self.zero_g else torch.zeros_like(g_tgt),
+                         x_mask=y_mask if y.size(0) > 1 else None)
         return o_hat, y_mask, (z, z_p, z_hat)
+
+    def remove_weight_norm(self):
+        # folds every weight norm reparameterization into a plain weight, for inference only
+        self.dec.remove_weight_norm()
+        self.flow.remove_weight_norm()
+        if hasattr(self, 'enc_q'):
+            self.enc_q.remove_weight_norm()
+        if hasattr(self, 'ref_enc'):
+            self.ref_enc.remove_weight_norm()
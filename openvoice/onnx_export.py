@@ -0,0 +1,203 @@
+"""
+Export the tone color converter to ONNX and run it with onnxruntime.
+
+    python -m openvoice.onnx_export --ckpt_converter checkpoints_v2/converter --output_dir checkpoints_v2/converter/onnx --check
+
+voice_conversion is split into enc_q.onnx, flow.onnx, flow_reverse.onnx and dec.onnx, the reference
+encoder is ref_enc.onnx. Batch and time dimensions are dynamic. The sampling noise of enc_q is drawn
+outside the graphs, so both backends give the same result for the same torch seed.
+"""
+import os
+import argparse
+
+import torch
+from torch import nn
+
+from openvoice import commons
+
+PARTS = ('enc_q', 'flow', 'flow_reverse', 'dec', 'ref_enc')
+
+
+class PosteriorEncoderExport(nn.Module):
+    def __init__(self, enc_q):
+        super().__init__()
+        self.enc_q = enc_q
+
+    def forward(self, y, y_lengths, g):
+        enc_q = self.enc_q
+        y_mask = torch.unsqueeze(commons.sequence_mask(y_lengths, y.size(2)), 1).to(y.dtype)
+        x = enc_q.pre(y) * y_mask
+        x = enc_q.enc(x, y_mask, g=g)
+        stats = enc_q.proj(x) * y_mask
+        m, logs = torch.split(stats, enc_q.out_channels, dim=1)
+        return m, logs, y_mask
+
+
+class FlowExport(nn.Module):
+    def __init__(self, flow, reverse):
+        super().__init__()
+        self.flow = flow
+        self.reverse = reverse
+
+    def forward(self, z, y_mask, g):
+        return self.flow(z, y_mask, g=g, reverse=self.reverse)
+
+
+class DecoderExport(nn.Module):
+    def __init__(self, dec):
+        super().__init__()
+        self.dec = dec
+
+    def forward(self, z, y_mask, g):
+        # always masked, an all-ones mask leaves a single clip unchanged
+        return self.dec(z * y_mask, g=g, x_mask=y_mask)
+
+
+class ReferenceEncoderExport(nn.Module):
+    def __init__(self, ref_enc):
+        super().__init__()
+        self.ref_enc = ref_enc
+
+    def forward(self, spec):
+        return self.ref_enc(spec)
+
+
+def export_converter(converter, output_dir, opset_version=17, frames=100):
+    """
+    Write the ONNX graphs of a loaded ToneColorConverter to output_dir.
+    Weight norms are folded first, see optimize_for_inference.
+    """
+    if not converter.inference_optimized:
+        converter.optimize_for_inference()
+    model = converter.model
+    os.makedirs(output_dir, exist_ok=True)
+
+    spec_channels = converter.hps.data.filter_length // 2 + 1
+    inter_channels = converter.hps.model.inter_channels
+    gin_channels = getattr(converter.hps.model, 'gin_channels', 256)
+    spec = torch.rand(1, spec_channels, frames)
+    lengths = torch.LongTensor([frames])
+    z = torch.randn(1, inter_channels, frames)
+    y_mask = torch.ones(1, 1, frames)
+    g = torch.randn(1, gin_channels, 1)
+
+    batch_time = {0: 'batch', 2: 'frames'}
+    exports = {
+        'enc_q': (PosteriorEncoderExport(model.enc_q), (spec, lengths, g), ['y', 'y_lengths', 'g'],
+                  ['m', 'logs', 'y_mask'],
+                  {'y': batch_time, 'y_lengths': {0: 'batch'}, 'g': {0: 'batch'},
+                   'm': batch_time, 'logs': batch_time, 'y_mask': batch_time}),
+        'flow': (FlowExport(model.flow, False), (z, y_mask, g), ['z', 'y_mask', 'g'], ['z_out'],
+                 {'z': batch_time, 'y_mask': batch_time, 'g': {0: 'batch'}, 'z_out': batch_time}),
+        'flow_reverse': (FlowExport(model.flow, True), (z, y_mask, g), ['z', 'y_mask', 'g'], ['z_out'],
+                         {'z': batch_time, 'y_mask': batch_time, 'g': {0: 'batch'}, 'z_out': batch_time}),
+        'dec': (DecoderExport(model.dec), (z, y_mask, g), ['z', 'y_mask', 'g'], ['o'],
+                {'z': batch_time, 'y_mask': batch_time, 'g': {0: 'batch'}, 'o': {0: 'batch', 2: 'samples'}}),
+        'ref_enc': (ReferenceEncoderExport(model.ref_enc), (spec.transpose(1, 2),), ['spec'], ['g'],
+                    {'spec': {0: 'batch', 1: 'frames'}, 'g': {0: 'batch'}}),
+    }
+    for name, (module, args, input_names, output_names, dynamic_axes) in exports.items():
+        path = os.path.join(output_dir, f'{name}.onnx')
+        torch.onnx.export(module.eval(), args, path, input_names=input_names, output_names=output_names,
+                          dynamic_axes=dynamic_axes, opset_version=opset_version)
+        print(f"Exported {name} to '{path}'")
+
+
+class OnnxSynthesizer(object):
+    """
+    The voice_conversion and ref_enc entry points of SynthesizerTrn on onnxruntime sessions,
+    with torch tensors in and out, so ToneColorConverter can use it as its model.
+    """
+
+    def __init__(self, onnx_dir, zero_g=False, intra_op_threads=0, inter_op_threads=0,
+                 providers=('CPUExecutionProvider',)):
+        import onnxruntime as ort
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = intra_op_threads
+        options.inter_op_num_threads = inter_op_threads
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.sessions = {
+            name: ort.InferenceSession(os.path.join(onnx_dir, f'{name}.onnx'), options, providers=list(providers))
+            for name in PARTS
+        }
+        self.zero_g = zero_g
+
+    def eval(self):
+        return self
+
+    def run(self, name, **inputs):
+        feeds = {k: v.detach().cpu().numpy() for k, v in inputs.items()}
+        return [torch.from_numpy(output) for output in self.sessions[name].run(None, feeds)]
+
+    def voice_conversion(self, y, y_lengths, sid_src, sid_tgt, tau=1.0):
+        device = y.device
+        g_src = sid_src.float()
+        g_tgt = sid_tgt.float()
+        m, logs, y_mask = self.run('enc_q', y=y.float(), y_lengths=y_lengths.long(),
+                                   g=torch.zeros_like(g_src) if self.zero_g else g_src)
+        z = (m + torch.randn_like(m) * tau * torch.exp(logs)) * y_mask
+        z_p, = self.run('flow', z=z, y_mask=y_mask, g=g_src)
+        z_hat, = self.run('flow_reverse', z=z_p, y_mask=y_mask, g=g_tgt)
+        o_hat, = self.run('dec', z=z_hat, y_mask=y_mask, g=torch.zeros_like(g_tgt) if self.zero_g else g_tgt)
+        return o_hat.to(device), y_mask.to(device), (z.to(device), z_p.to(device), z_hat.to(device))
+
+    def ref_enc(self, inputs, mask=None):
+        if mask is None:
+            g, = self.run('ref_enc', spec=inputs.float())
+            return g.to(inputs.device)
+        # the graph has no packed GRU, padded batches are encoded one trimmed item at a time
+        lengths = mask.sum(-1).long().tolist()
+        return torch.cat([self.ref_enc(inputs[i:i + 1, :length]) for i, length in enumerate(lengths)], dim=0)
+
+
+def check_parity(converter, onnx_converter, n_trials=3, atol=1e-3):
+    """Max abs difference of ref_enc and voice_conversion between the backends, on random inputs."""
+    spec_channels = converter.hps.data.filter_length // 2 + 1
+    deviations = {'ref_enc': 0., 'voice_conversion': 0.}
+    for trial in range(n_trials):
+        frames = [80, 173, 301][trial % 3]
+        spec = torch.rand(1, spec_channels, frames)
+        lengths = torch.LongTensor([frames])
+        with torch.no_grad():
+            se = converter.model.ref_enc(spec.transpose(1, 2)).unsqueeze(-1)
+            se_onnx = onnx_converter.model.ref_enc(spec.transpose(1, 2)).unsqueeze(-1)
+            tgt = se.flip(1)
+            o = converter.model.voice_conversion(spec, lengths, sid_src=se, sid_tgt=tgt, tau=0.)[0]
+            o_onnx = onnx_converter.model.voice_conversion(spec, lengths, sid_src=se, sid_tgt=tgt, tau=0.)[0]
+        deviations['ref_enc'] = max(deviations['ref_enc'], (se - se_onnx).abs().max().item())
+        deviations['voice_conversion'] = max(deviations['voice_conversion'], (o - o_onnx).abs().max().item())
+    print('max abs difference, pytorch vs onnxruntime:', deviations)
+    for name, deviation in deviations.items():
+        assert deviation < atol, f"{name} differs by {deviation} between the backends"
+    return deviations
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description="Export the tone color converter to ONNX.")
+    parser.add_argument('--ckpt_converter', default='checkpoints_v2/converter')
+    parser.add_argument('--output_dir', default=None, help="defaults to <ckpt_converter>/onnx")
+    parser.add_argument('--opset', type=int, default=17)
+    parser.add_argument('--check', action='store_true', help="compare onnxruntime with pytorch on random inputs")
+    parser.add_argument('--intra_op_threads', type=int, default=0)
+    parser.add_argument('--inter_op_threads', type=int, default=0)
+    return parser
+
+
+def main():
+    from openvoice.api import ToneColorConverter, OnnxToneColorConverter
+    args = get_parser().parse_args()
+    output_dir = args.output_dir or os.path.join(args.ckpt_converter, 'onnx')
+    config_path = os.path.join(args.ckpt_converter, 'config.json')
+
+    converter = ToneColorConverter(config_path, device='cpu', enable_watermark=False)
+    converter.load_ckpt(os.path.join(args.ckpt_converter, 'checkpoint.pth'))
+    export_converter(converter, output_dir, opset_version=args.opset)
+
+    if args.check:
+        onnx_converter = OnnxToneColorConverter(config_path, output_dir, intra_op_threads=args.intra_op_threads,
+                                                inter_op_threads=args.inter_op_threads, enable_watermark=False)
+        check_parity(converter, onnx_converter)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+import time
+import threading
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+
+class StageTimer(object):
+    """Accumulated wall time and number of calls per pipeline stage."""
+
+    def __init__(self):
+        self.totals = defaultdict(float)
+        self.counts = defaultdict(int)
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name, seconds):
+        with self.lock:
+            self.totals[name] += seconds
+            self.counts[name] += 1
+
+    def summary(self):
+        with self.lock:
+            return {
+                name: {
+                    'total': self.totals[name],
+                    'count': self.counts[name],
+                    'mean': self.totals[name] / max(self.counts[name], 1),
+                }
+                for name in self.totals
+            }
+
+
+_frontend_executor = None
+_frontend_lock = threading.Lock()
+
+
+def get_frontend_executor(max_workers=2):
+    """Thread pool shared by all models for the CPU-bound text frontend (cleaners, phonemizers)."""
+    global _frontend_executor
+    with _frontend_lock:
+        if _frontend_executor is None:
+            _frontend_executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='openvoice-frontend')
+        return _frontend_executor
+
+
+def prefetch_map(fn, items, executor=None, depth=4, timer=None, stage='frontend'):
+    """
+    Yield fn(item) for every item, in order, while the next items are already being
+    processed in the executor. At most depth items are in flight, so a long document is
+    never run through the frontend far ahead of the model that consumes it.
+    Time spent in fn is recorded as `stage`, time the consumer waits for it as `stage`_wait.
+    """
+    executor = executor if executor is not None else get_frontend_executor()
+
+    def run(item):
+        if timer is None:
+            return fn(item)
+        with timer.stage(stage):
+            return fn(item)
+
+    pending = deque()
+    items = iter(items)
+    try:
+        while True:
+            while len(pending) < depth:
+                try:
+                    item = next(items)
+                except StopIteration:
+                    break
+                pending.append(executor.submit(run, item))
+            if len(pending) == 0:
+                return
+            future = pending.popleft()
+            if timer is None:
+                result = future.result()
+            else:
+                with timer.stage(f'{stage}_wait'):
+                    result = future.result()
+            yield result
+    finally:
+        for future in pending:
+            future.cancel()
@@ -0,0 +1,128 @@
+"""
+int8 inference on CPU.
+
+Linear and GRU layers (reference encoder) are quantized dynamically. The Conv1d layers of the
+Generator resblocks, the WN stacks (enc_q, flows) and the text encoder FFNs are quantized statically
+with per-channel int8 weights, their activation ranges come from a calibration pass over real inputs.
+
+    python -m openvoice.quantization --ckpt_converter checkpoints_v2/converter --calibration_dir resources
+
+calibrates the converter on a folder of reference audio, saves the int8 checkpoint and reports the
+latency, the weight memory and the spectral distance against fp32.
+"""
+import io
+import os
+import time
+import argparse
+
+import numpy as np
+import torch
+from torch import nn
+from torch.ao import quantization as tq
+
+from openvoice import modules
+from openvoice import attentions
+from openvoice.watermark import list_audio_files
+
+# the conv stacks that are statically quantized, conv_pre / conv_post and the upsampling
+# ConvTranspose1d layers of the Generator stay in fp32
+STATIC_PARENTS = (modules.ResBlock1, modules.ResBlock2, modules.WN, attentions.FFN)
+
+
+class QuantizedConv1d(nn.Sequential):
+    """A Conv1d between a quantize and a dequantize step, so it fits into the fp32 graph around it."""
+
+    def __init__(self, conv):
+        super().__init__(tq.QuantStub(), conv, tq.DeQuantStub())
+        self.qconfig = tq.get_default_qconfig(torch.backends.quantized.engine)
+
+
+def quantize_dynamic(model):
+    tq.quantize_dynamic(model, {nn.Linear, nn.GRU}, dtype=torch.qint8, inplace=True)
+
+
+def prepare_static(model):
+    """Wrap the Conv1d layers of the conv stacks and attach the observers that record their ranges."""
+    for parent in list(model.modules()):
+        if not isinstance(parent, STATIC_PARENTS):
+            continue
+        for name, child in list(parent.named_children()):
+            if isinstance(child, nn.ModuleList):
+                for i, conv in enumerate(child):
+                    if type(conv) is nn.Conv1d:
+                        child[i] = QuantizedConv1d(conv)
+            elif type(child) is nn.Conv1d:
+                setattr(parent, name, QuantizedConv1d(child))
+    tq.prepare(model, inplace=True)
+
+
+def convert_static(model):
+    tq.convert(model, inplace=True, remove_qconfig=False)
+
+
+def weight_nbytes(model):
+    """Size of the serialized weights, packed int8 weights are not visible as parameters."""
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.getbuffer().nbytes
+
+
+def spectral_distance(reference, audio, n_fft=1024, hop_length=256):
+    """Log-spectral distance in dB between two waveforms, averaged over frames."""
+    n = min(len(reference), len(audio))
+    window = torch.hann_window(n_fft)
+    specs = [torch.stft(torch.as_tensor(np.asarray(x[:n], dtype=np.float32)), n_fft, hop_length=hop_length,
+                        window=window, return_complex=True).abs() for x in (reference, audio)]
+    log_specs = [10 * torch.log10(spec.pow(2) + 1e-8) for spec in specs]
+    return float(torch.sqrt((log_specs[0] - log_specs[1]).pow(2).mean(0)).mean())
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description="Calibrate and evaluate an int8 tone color converter.")
+    parser.add_argument('--ckpt_converter', default='checkpoints_v2/converter')
+    parser.add_argument('--calibration_dir', default='resources', help="folder of reference audio")
+    parser.add_argument('--max_files', type=int, default=16)
+    parser.add_argument('--output', default=None, help="defaults to <ckpt_converter>/checkpoint_int8.pth")
+    return parser
+
+
+def main():
+    from openvoice.api import ToneColorConverter
+    args = get_parser().parse_args()
+    config_path = os.path.join(args.ckpt_converter, 'config.json')
+    ckpt_path = os.path.join(args.ckpt_converter, 'checkpoint.pth')
+    output = args.output or os.path.join(args.ckpt_converter, 'checkpoint_int8.pth')
+    audio_paths = list_audio_files(args.calibration_dir)[:args.max_files]
+    assert len(audio_paths) > 0, f"no audio files in {args.calibration_dir}"
+
+    fp32 = ToneColorConverter(config_path, device='cpu', enable_watermark=False)
+    fp32.load_ckpt(ckpt_path)
+    fp32.optimize_for_inference()
+    int8 = ToneColorConverter(config_path, device='cpu', enable_watermark=False)
+    int8.load_ckpt(ckpt_path)
+    int8.quantize(calibration_data=audio_paths)
+    int8.save_quantized_ckpt(output)
+
+    # every file is converted to the tone color of the next one
+    ses = [fp32.extract_se(path) for path in audio_paths]
+    latency = {'fp32': 0., 'int8': 0.}
+    distances = []
+    for i, path in enumerate(audio_paths):
+        tgt_se = ses[(i + 1) % len(ses)]
+        outputs = {}
+        for name, converter in (('fp32', fp32), ('int8', int8)):
+            torch.manual_seed(0)
+            start = time.perf_counter()
+            outputs[name] = converter.convert(path, ses[i], tgt_se, tau=0.)
+            latency[name] += time.perf_counter() - start
+        distances.append(spectral_distance(outputs['fp32'], outputs['int8']))
+
+    print(f"latency   fp32 {latency['fp32']:.2f}s  int8 {latency['int8']:.2f}s "
+          f"({latency['fp32'] / max(latency['int8'], 1e-9):.2f}x)")
+    print(f"weights   fp32 {weight_nbytes(fp32.model) / 2 ** 20:.1f} MB  "
+          f"int8 {weight_nbytes(int8.model) / 2 ** 20:.1f} MB")
+    print(f"spectral distance to fp32: {np.mean(distances):.2f} dB (max {np.max(distances):.2f} dB)")
+
+
+if __name__ == '__main__':
+    main()
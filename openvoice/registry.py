@@ -0,0 +1,97 @@
+import itertools
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import torch
+
+
+def model_nbytes(model):
+    """Resident size of a model's parameters and buffers, in bytes."""
+    module = model if isinstance(model, torch.nn.Module) else getattr(model, 'model', None)
+    if not isinstance(module, torch.nn.Module):
+        return 0
+    return sum(t.numel() * t.element_size() for t in itertools.chain(module.parameters(), module.buffers()))
+
+
+class ModelRegistry(object):
+    """
+    Process-wide store of loaded models, e.g. one TTS model per language.
+    A model is built by loader(key) on first use and then stays resident while the
+    registry fits in max_bytes / max_models, least recently used models are evicted
+    first. Every model has its own lock, so worker threads share one instance and
+    run inference on it one request at a time.
+    """
+
+    def __init__(self, loader, max_bytes=None, max_models=None):
+        self.loader = loader
+        self.max_bytes = max_bytes
+        self.max_models = max_models
+        self.models = OrderedDict()
+        self.lock = threading.Lock()
+        self.load_locks = {}
+        self.model_locks = {}
+        self.loads = 0
+        self.hits = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self.lock:
+            if key in self.models:
+                self.models.move_to_end(key)
+                self.hits += 1
+                return self.models[key][0]
+            load_lock = self.load_locks.setdefault(key, threading.Lock())
+
+        # only one thread loads a given model, the others wait for it
+        with load_lock:
+            with self.lock:
+                if key in self.models:
+                    self.models.move_to_end(key)
+                    self.hits += 1
+                    return self.models[key][0]
+            model = self.loader(key)
+            nbytes = model_nbytes(model)
+            with self.lock:
+                self.models[key] = (model, nbytes)
+                self.model_locks.setdefault(key, threading.Lock())
+                self.loads += 1
+                self._evict(keep=key)
+        return model
+
+    @contextmanager
+    def acquire(self, key):
+        model = self.get(key)
+        with self.lock:
+            model_lock = self.model_locks.setdefault(key, threading.Lock())
+        with model_lock:
+            yield model
+
+    def _evict(self, keep):
+        # an evicted model that is still in use stays alive until its caller is done
+        while len(self.models) > 1:
+            over_bytes = self.max_bytes is not None and self.nbytes() > self.max_bytes
+            over_count = self.max_models is not None and len(self.models) > self.max_models
+            if not (over_bytes or over_count):
+                break
+            key = next(k for k in self.models if k != keep)
+            del self.models[key]
+            self.evictions += 1
+            print(f"Evicted model '{key}' from the registry")
+
+    def nbytes(self):
+        return sum(nbytes for _, nbytes in self.models.values())
+
+    def keys(self):
+        with self.lock:
+            return list(self.models.keys())
+
+    def stats(self):
+        with self.lock:
+            return {
+                'models': list(self.models.keys()),
+                'resident_bytes': self.nbytes(),
+                'loads': self.loads,
+                'hits': self.hits,
+                'evictions': self.evictions,
+            }
@@ -1,153 +1,447 @@
 import os
 import glob
+import json
 import torch
 import hashlib
 import librosa
 import base64
+import soundfile
+import tempfile
+import threading
 from glob import glob
+from collections import OrderedDict
 import numpy as np
-from pydub import AudioSegment
 from faster_whisper import WhisperModel
 import hashlib
 import base64
 import librosa
-from whisper_timestamped.transcribe import get_audio_tensor, get_vad_segments
+from whisper_timestamped.transcribe import get_vad_segments
 
-model_size = "medium"
-# Run on GPU with FP16
+# Whisper is only used to find speech segments, so decoding is greedy by default.
+# device / compute_type 'auto' run float16 on GPU and int8 on CPU-only nodes.
+whisper_config = {
+    'model_size': 'medium',
+    'device': 'auto',
+    'compute_type': 'auto',
+    'beam_size': 1,
+    'cpu_threads': 0,
+}
 model = None
-def split_audio_whisper(audio_path, audio_name, target_dir='processed'):
+model_lock = threading.Lock()
+_transcriptions = OrderedDict()
+_transcriptions_lock = threading.Lock()
+
+
+def configure_whisper(**kwargs):
+    """Change whisper_config, the model is reloaded on next use."""
     global model
-    if model is None:
-        model = WhisperModel(model_size, device="cuda", compute_type="float16")
-    audio = AudioSegment.from_file(audio_path)
-    max_len = len(audio)
+    unknown = set(kwargs) - set(whisper_config)
+    assert len(unknown) == 0, f"unknown whisper options: {unknown}"
+    with model_lock:
+        whisper_config.update(kwargs)
+        model = None
 
-    target_folder = os.path.join(target_dir, audio_name)
-    
-    segments, info = model.transcribe(audio_path, beam_size=5, word_timestamps=True)
-    segments = list(segments)    
 
-    # create directory
-    os.makedirs(target_folder, exist_ok=True)
-    wavs_folder = os.path.join(target_folder, 'wavs')
-    os.makedirs(wavs_folder, exist_ok=True)
+def get_whisper_model():
+    global model
+    with model_lock:
+        if model is None:
+            device = whisper_config['device']
+            if device == 'auto':
+                device = 'cuda' if torch.cuda.is_available() else 'cpu'
+            compute_type = whisper_config['compute_type']
+            if compute_type == 'auto':
+                compute_type = 'float16' if device == 'cuda' else 'int8'
+            model = WhisperModel(whisper_config['model_size'], device=device, compute_type=compute_type,
+                                 cpu_threads=whisper_config['cpu_threads'])
+        return model
 
-    # segments
-    s_ind = 0
-    start_time = None
-    
-    for k, w in enumerate(segments):
-        # process with the time
-        if k == 0:
-            start_time = max(0, w.start)
 
-        end_time = w.end
+def _remember_transcription(key, segments):
+    # least recently used transcriptions are evicted first, like _file_hashes
+    with _transcriptions_lock:
+        _transcriptions[key] = segments
+        _transcriptions.move_to_end(key)
+        while len(_transcriptions) > 256:
+            _transcriptions.popitem(last=False)
 
-        # calculate confidence
-        if len(w.words) > 0:
-            confidence = sum([s.probability for s in w.words]) / len(w.words)
-        else:
-            confidence = 0.
-        # clean text
-        text = w.text.replace('...', '')
 
-        # left 0.08s for each audios
-        audio_seg = audio[int( start_time * 1000) : min(max_len, int(end_time * 1000) + 80)]
+def transcribe_segments(audio, sr, audio_hash=None, cache_dir=None):
+    """
+    Yield (start, end, text) of every Whisper segment as soon as it is decoded.
+    With an audio_hash the result is cached in memory and as json in cache_dir,
+    so the same reference is never transcribed twice.
+    """
+    key = None
+    if audio_hash is not None:
+        key = f"{audio_hash}_{whisper_config['model_size']}_{whisper_config['beam_size']}"
+        with _transcriptions_lock:
+            segments = _transcriptions.get(key)
+            if segments is not None:
+                _transcriptions.move_to_end(key)
+        if segments is not None:
+            yield from segments
+            return
+        cache_path = None if cache_dir is None else os.path.join(cache_dir, f'{key}.json')
+        if cache_path is not None and os.path.isfile(cache_path):
+            with open(cache_path, 'r', encoding='utf-8') as f:
+                segments = [tuple(seg) for seg in json.load(f)]
+            _remember_transcription(key, segments)
+            yield from segments
+            return
 
-        # segment file name
-        fname = f"{audio_name}_seg{s_ind}.wav"
+    audio_16k = np.asarray(audio, dtype=np.float32).reshape(-1)
+    if sr != 16000:
+        audio_16k = librosa.resample(audio_16k, orig_sr=sr, target_sr=16000)
+    segments_iter, info = get_whisper_model().transcribe(audio_16k, beam_size=whisper_config['beam_size'])
+
+    segments = []
+    for w in segments_iter:
+        segment = (w.start, w.end, w.text)
+        segments.append(segment)
+        yield segment
+
+    if key is not None:
+        _remember_transcription(key, segments)
+        if cache_path is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            with open(cache_path, 'w', encoding='utf-8') as f:
+                json.dump(segments, f, ensure_ascii=False)
+
+
+def split_audio_whisper_arrays(audio, sr, audio_hash=None, cache_dir=None):
+    """
+    Yield the speech segments Whisper finds in a mono waveform as arrays sampled at sr,
+    each one as soon as it is transcribed.
+    """
+    audio = np.asarray(audio, dtype=np.float32).reshape(-1)
+    max_len = len(audio)
+
+    for k, (start, end_time, text) in enumerate(transcribe_segments(audio, sr, audio_hash, cache_dir)):
+        # left 0.08s before every segment but the first one, and 0.08s after each
+        start_time = max(0, start) if k == 0 else max(0, start - 0.08)
+
+        # clean text
+        text = text.replace('...', '')
+
+        audio_seg = audio[int(start_time * sr): min(max_len, int((end_time + 0.08) * sr))]
+        duration = len(audio_seg) / sr
 
         # filter out the segment shorter than 1.5s and longer than 20s
-        save = audio_seg.duration_seconds > 1.5 and \
-                audio_seg.duration_seconds < 20. and \
-                len(text) >= 2 and len(text) < 200 
+        if duration > 1.5 and duration < 20. and len(text) >= 2 and len(text) < 200:
+            yield k, audio_seg
+
 
-        if save:
-            output_file = os.path.join(wavs_folder, fname)
-            audio_seg.export(output_file, format='wav')
+def split_audio_whisper(audio_path, audio_name, target_dir='processed'):
+    audio, sr = librosa.load(audio_path, sr=None, mono=True)
 
-        if k < len(segments) - 1:
-            start_time = max(0, segments[k+1].start - 0.08)
+    target_folder = os.path.join(target_dir, audio_name)
+    wavs_folder = os.path.join(target_folder, 'wavs')
+    os.makedirs(wavs_folder, exist_ok=True)
 
-        s_ind = s_ind + 1
+    for s_ind, audio_seg in split_audio_whisper_arrays(audio, sr):
+        # segment file name
+        fname = f"{audio_name}_seg{s_ind}.wav"
+        soundfile.write(os.path.join(wavs_folder, fname), audio_seg, sr)
     return wavs_folder
 
 
-def split_audio_vad(audio_path, audio_name, target_dir, split_seconds=10.0):
+def split_audio_vad_arrays(audio, sr, split_seconds=10.0):
+    """
+    In-memory VAD segmentation: keep the voiced regions of a mono waveform and cut them into
+    pieces of about split_seconds. Returns a list of arrays sampled at sr, nothing touches disk.
+    """
     SAMPLE_RATE = 16000
-    audio_vad = get_audio_tensor(audio_path)
+    audio = np.asarray(audio, dtype=np.float32).reshape(-1)
+    audio_vad = audio if sr == SAMPLE_RATE else librosa.resample(audio, orig_sr=sr, target_sr=SAMPLE_RATE)
     segments = get_vad_segments(
-        audio_vad,
+        torch.from_numpy(np.ascontiguousarray(audio_vad)),
         output_sample=True,
         min_speech_duration=0.1,
         min_silence_duration=1,
         method="silero",
     )
-    segments = [(seg["start"], seg["end"]) for seg in segments]
-    segments = [(float(s) / SAMPLE_RATE, float(e) / SAMPLE_RATE) for s,e in segments]
-    print(segments)
-    audio_active = AudioSegment.silent(duration=0)
-    audio = AudioSegment.from_file(audio_path)
-
-    for start_time, end_time in segments:
-        audio_active += audio[int( start_time * 1000) : int(end_time * 1000)]
-    
-    audio_dur = audio_active.duration_seconds
+    segments = [(int(seg["start"]) * sr // SAMPLE_RATE, int(seg["end"]) * sr // SAMPLE_RATE) for seg in segments]
+    print([(s / sr, e / sr) for s, e in segments])
+
+    # one copy of the voiced samples instead of growing a buffer segment by segment
+    if len(segments) > 0:
+        audio_active = np.concatenate([audio[s:e] for s, e in segments])
+    else:
+        audio_active = audio[:0]
+
+    audio_dur = len(audio_active) / sr
     print(f'after vad: dur = {audio_dur}')
-    target_folder = os.path.join(target_dir, audio_name)
-    wavs_folder = os.path.join(target_folder, 'wavs')
-    os.makedirs(wavs_folder, exist_ok=True)
-    start_time = 0.
-    count = 0
     num_splits = int(np.round(audio_dur / split_seconds))
     assert num_splits > 0, 'input audio is too short'
-    interval = audio_dur / num_splits
+    bounds = np.linspace(0, len(audio_active), num_splits + 1).astype(np.int64)
+    return [audio_active[bounds[i]:bounds[i + 1]] for i in range(num_splits)]
 
-    for i in range(num_splits):
-        end_time = min(start_time + interval, audio_dur)
-        if i == num_splits - 1:
-            end_time = audio_dur
+
+def split_audio_vad(audio_path, audio_name, target_dir, split_seconds=10.0):
+    audio, sr = librosa.load(audio_path, sr=None, mono=True)
+    audio_segs = split_audio_vad_arrays(audio, sr, split_seconds=split_seconds)
+
+    target_folder = os.path.join(target_dir, audio_name)
+    wavs_folder = os.path.join(target_folder, 'wavs')
+    os.makedirs(wavs_folder, exist_ok=True)
+    for count, audio_seg in enumerate(audio_segs):
         output_file = f"{wavs_folder}/{audio_name}_seg{count}.wav"
-        audio_seg = audio_active[int(start_time * 1000): int(end_time * 1000)]
-        audio_seg.export(output_file, format='wav')
-        start_time = end_time
-        count += 1
+        soundfile.write(output_file, audio_seg, sr)
     return wavs_folder
 
+def _short_hash(hash_value):
+    # Convert the hash value to base64
+    base64_value = base64.b64encode(hash_value)
+    return base64_value.decode('utf-8')[:16].replace('/', '_^')
+
+
 def hash_numpy_array(audio_path):
-    array, _ = librosa.load(audio_path, sr=None, mono=True)
+    if isinstance(audio_path, np.ndarray):
+        array = np.ascontiguousarray(audio_path, dtype=np.float32)
+    else:
+        array, _ = librosa.load(audio_path, sr=None, mono=True)
     # Convert the array to bytes
     array_bytes = array.tobytes()
     # Calculate the hash of the array bytes
     hash_object = hashlib.sha256(array_bytes)
     hash_value = hash_object.digest()
-    # Convert the hash value to base64
-    base64_value = base64.b64encode(hash_value)
-    return base64_value.decode('utf-8')[:16].replace('/', '_^')
+    return _short_hash(hash_value)
+
+
+_file_hashes = OrderedDict()
+_file_hashes_lock = threading.Lock()
+
+
+def hash_audio_file(audio_path, max_bytes=16 * 1024 * 1024, block_size=1024 * 1024):
+    """
+    Fingerprint of the encoded file, no decoding. Files up to max_bytes are hashed completely,
+    larger ones by their size plus max_bytes spread over head, middle and tail, so the cost is
+    bounded. The fingerprint only depends on the content, so it is stable across runs and copies;
+    (path, size, mtime) is only used to skip re-reading a file that has not changed.
+    """
+    st = os.stat(audio_path)
+    stat_key = (os.path.realpath(audio_path), st.st_size, st.st_mtime_ns, max_bytes)
+    with _file_hashes_lock:
+        if stat_key in _file_hashes:
+            _file_hashes.move_to_end(stat_key)
+            return _file_hashes[stat_key]
+
+    hash_object = hashlib.sha256(str(st.st_size).encode('utf-8'))
+    with open(audio_path, 'rb') as f:
+        if max_bytes is None or st.st_size <= max_bytes:
+            ranges = [(0, st.st_size)]
+        else:
+            part = max_bytes // 3
+            ranges = [(0, part), ((st.st_size - part) // 2, part), (st.st_size - part, part)]
+        for offset, length in ranges:
+            f.seek(offset)
+            while length > 0:
+                block = f.read(min(block_size, length))
+                if not block:
+                    break
+                hash_object.update(block)
+                length -= len(block)
+    audio_hash = _short_hash(hash_object.digest())
+
+    with _file_hashes_lock:
+        _file_hashes[stat_key] = audio_hash
+        while len(_file_hashes) > 1024:
+            _file_hashes.popitem(last=False)
+    return audio_hash
+
+
+class EmbeddingCache(object):
+    """
+    Speaker embeddings keyed by audio content hash, model version and extraction parameters.
+    Two tiers: an in-memory LRU of at most max_items embeddings, and .pth files in a cache
+    folder that are evicted oldest-first once they take more than max_disk_bytes.
+    """
+
+    def __init__(self, max_items=256, max_disk_bytes=64 * 1024 * 1024):
+        self.max_items = max_items
+        self.max_disk_bytes = max_disk_bytes
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(audio_hash, version, **params):
+        params = json.dumps(params, sort_keys=True)
+        key = hashlib.sha256(f'{audio_hash}|{version}|{params}'.encode('utf-8')).hexdigest()
+        return key[:32]
+
+    def get(self, key, cache_dir=None):
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.hits += 1
+                return self.memory[key]
 
-def get_se(audio_path, vc_model, target_dir='processed', vad=True):
+        if cache_dir is not None:
+            path = os.path.join(cache_dir, f'{key}.pth')
+            if os.path.isfile(path):
+                se = torch.load(path, map_location='cpu')
+                # refresh mtime, the disk tier evicts the least recently used files first
+                os.utime(path)
+                with self.lock:
+                    self.disk_hits += 1
+                    self._remember(key, se)
+                return se
+
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, se, cache_dir=None):
+        se = se.detach().cpu()
+        with self.lock:
+            self._remember(key, se)
+
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            path = os.path.join(cache_dir, f'{key}.pth')
+            tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            torch.save(se, tmp_path)
+            os.replace(tmp_path, path)
+            self._evict_disk(cache_dir)
+
+    def _remember(self, key, se):
+        self.memory[key] = se
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_items:
+            self.memory.popitem(last=False)
+
+    def _evict_disk(self, cache_dir):
+        files = []
+        for path in glob(os.path.join(cache_dir, '*.pth')):
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            files.append((st.st_mtime, st.st_size, path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def clear(self):
+        with self.lock:
+            self.memory.clear()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'items': len(self.memory),
+            }
+
+
+se_cache = EmbeddingCache()
+
+
+def model_fingerprint(vc_model):
+    """
+    Identity of the weights vc_model computes embeddings with: its config, the checkpoint (or ONNX
+    directory) path, size and mtime, and the precision it runs at.
+    """
+    h = hashlib.sha256()
+    with open(vc_model.config_path, 'rb') as f:
+        h.update(f.read())
+    weights_path = vc_model.ckpt_path or getattr(vc_model, 'onnx_dir', None)
+    if weights_path is not None:
+        st = os.stat(weights_path)
+        h.update(f'{os.path.realpath(weights_path)}:{st.st_size}:{st.st_mtime_ns}'.encode('utf-8'))
+    h.update(f'{vc_model.precision}:{vc_model.quantized}'.encode('utf-8'))
+    return h.hexdigest()[:16]
+
+
+def get_se(audio_path, vc_model, target_dir='processed', vad=True, use_cache=True):
     device = vc_model.device
     version = vc_model.version
     print("OpenVoice version:", version)
 
-    audio_name = f"{os.path.basename(audio_path).rsplit('.', 1)[0]}_{version}_{hash_numpy_array(audio_path)}"
+    # cache key from the file bytes, the audio is decoded at most once, and only on a cache miss
+    audio_hash = hash_audio_file(audio_path)
+    audio_name = f"{os.path.basename(audio_path).rsplit('.', 1)[0]}_{version}_{audio_hash}"
     se_path = os.path.join(target_dir, audio_name, 'se.pth')
 
-    # if os.path.isfile(se_path):
-    #     se = torch.load(se_path).to(device)
-    #     return se, audio_name
-    # if os.path.isdir(audio_path):
-    #     wavs_folder = audio_path
+    cache_dir = os.path.join(target_dir, 'se_cache')
+    # segments found by whisper depend on its model and decoding, vad segments do not
+    whisper_params = {} if vad else {k: whisper_config[k] for k in ('model_size', 'beam_size')}
+    cache_key = se_cache.make_key(audio_hash, version, model=model_fingerprint(vc_model), vad=vad,
+                                  sampling_rate=vc_model.hps.data.sampling_rate, **whisper_params)
+    if use_cache:
+        se = se_cache.get(cache_key, cache_dir)
+        if se is not None:
+            return se.to(device), audio_name
     
+    # segments stay in memory and go straight into the reference encoder
+    sr = vc_model.hps.data.sampling_rate
+    audio, _ = librosa.load(audio_path, sr=sr, mono=True)
     if vad:
-        wavs_folder = split_audio_vad(audio_path, target_dir=target_dir, audio_name=audio_name)
+        audio_segs = split_audio_vad_arrays(audio, sr)
     else:
-        wavs_folder = split_audio_whisper(audio_path, target_dir=target_dir, audio_name=audio_name)
-    
-    audio_segs = glob(f'{wavs_folder}/*.wav')
+        audio_segs = [audio_seg for _, audio_seg in split_audio_whisper_arrays(
+            audio, sr, audio_hash=audio_hash, cache_dir=os.path.join(target_dir, 'whisper_cache'))]
     if len(audio_segs) == 0:
         raise NotImplementedError('No audio segments found!')
     
-    return vc_model.extract_se(audio_segs, se_save_path=se_path), audio_name
+    se = vc_model.extract_se(audio_segs, se_save_path=se_path, sr=sr)
+    if use_cache:
+        se_cache.put(cache_key, se, cache_dir)
+    return se, audio_name
+
+
+def base_speaker_key(speaker):
+    # MeloTTS spk2id keys (e.g. 'EN-US', 'EN_INDIA') -> file names under base_speakers/ses
+    return speaker.lower().replace('_', '-')
+
+
+def load_base_speaker_ses(ses_dir, device='cpu'):
+    """
+    Load every precomputed base speaker embedding ({speaker_key}.pth) in ses_dir once,
+    so the source tone color of a base speaker never has to be extracted per request.
+    """
+    ses = {}
+    for path in sorted(glob(os.path.join(ses_dir, '*.pth'))):
+        speaker_key = os.path.basename(path).rsplit('.', 1)[0]
+        ses[speaker_key] = torch.load(path, map_location=device)
+    return ses
+
+
+def melo_language_str(language):
+    # MeloTTS language -> language_str of utils.split_sentence
+    return 'ZH' if language in ('ZH', 'JP', 'KR') else 'EN'
+
 
+def get_tts_source_se(tts_model, speaker_id, tts_audio, sr, vc_model, source_ses, target_dir='processed'):
+    """
+    Source tone color of MeloTTS output: the preloaded base speaker embedding of speaker_id if there is
+    one, otherwise it is extracted from tts_audio.
+    """
+    for speaker, spk_id in tts_model.hps.data.spk2id.items():
+        if spk_id == speaker_id:
+            source_se = source_ses.get(base_speaker_key(speaker))
+            if source_se is not None:
+                return source_se
+    print(f"No preloaded embedding for speaker {speaker_id}, extracting it from the TTS output.")
+    # get_se segments a file on disk, give every call its own one
+    os.makedirs(target_dir, exist_ok=True)
+    fd, tts_file = tempfile.mkstemp(suffix='.wav', dir=target_dir)
+    os.close(fd)
+    try:
+        soundfile.write(tts_file, tts_audio, sr)
+        source_se, _ = get_se(tts_file, vc_model, target_dir=target_dir, vad=False)
+    finally:
+        os.remove(tts_file)
+    return source_se
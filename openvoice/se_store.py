@@ -0,0 +1,165 @@
+import os
+import json
+import torch
+import numpy as np
+
+
+class EmbeddingStore(object):
+    """
+    Tone color embeddings of many speakers in one memory-mapped float32 matrix
+    (embeddings.f32, one L2-normalised row per speaker) plus an index (index.json) of the ids and norms.
+    Loading the store maps the file instead of reading thousands of se.pth files, and
+    search() is a single matrix-vector product for cosine nearest neighbours.
+    Rows of deleted speakers are zeroed and reused by later additions.
+    add / add_many / delete only write the matrix, the index is written by flush(). Call flush() or
+    close(), or use the store as a context manager, otherwise the changes are lost on reopening.
+    """
+
+    def __init__(self, root, dim=256, capacity=1024):
+        self.root = root
+        self.matrix_path = os.path.join(root, 'embeddings.f32')
+        self.index_path = os.path.join(root, 'index.json')
+        os.makedirs(root, exist_ok=True)
+
+        if os.path.isfile(self.index_path):
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                index = json.load(f)
+            self.dim = index['dim']
+            self.ids = index['ids']
+            capacity = index['capacity']
+            norms = index.get('norms')
+        else:
+            self.dim = dim
+            self.ids = []
+            norms = []
+        self.rows = {speaker_id: row for row, speaker_id in enumerate(self.ids) if speaker_id is not None}
+        self.free_rows = [row for row, speaker_id in enumerate(self.ids) if speaker_id is None]
+        self._open(max(capacity, 1))
+        if norms is None:
+            # stores written before the rows were normalised
+            norms = np.linalg.norm(self.matrix[:len(self.ids)], axis=1)
+            self.matrix[:len(self.ids)] /= np.maximum(norms, 1e-8)[:, None]
+        self.norms = np.asarray(norms, dtype=np.float32)
+
+    def _open(self, capacity):
+        mode = 'r+' if os.path.isfile(self.matrix_path) else 'w+'
+        if mode == 'r+' and os.path.getsize(self.matrix_path) < capacity * self.dim * 4:
+            with open(self.matrix_path, 'r+b') as f:
+                f.truncate(capacity * self.dim * 4)
+        self.capacity = capacity
+        self.matrix = np.memmap(self.matrix_path, dtype=np.float32, mode=mode, shape=(capacity, self.dim))
+
+    def _grow(self, n_rows):
+        if n_rows <= self.capacity:
+            return
+        capacity = self.capacity
+        while capacity < n_rows:
+            capacity *= 2
+        self.matrix.flush()
+        del self.matrix
+        self._open(capacity)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, speaker_id):
+        return speaker_id in self.rows
+
+    def add(self, speaker_id, se):
+        self.add_many([speaker_id], [se])
+
+    def add_many(self, speaker_ids, ses):
+        """
+        Bulk insert or overwrite; ses is a list of [1, dim, 1] tensors or an [n, dim] array.
+        An id given more than once keeps its last embedding.
+        """
+        if torch.is_tensor(ses):
+            ses = ses.detach().cpu().numpy()
+        if not isinstance(ses, np.ndarray):
+            ses = np.stack([se.detach().cpu().numpy().reshape(-1) if torch.is_tensor(se)
+                            else np.asarray(se).reshape(-1) for se in ses])
+        ses = ses.reshape(len(speaker_ids), self.dim).astype(np.float32)
+        last = {speaker_id: i for i, speaker_id in enumerate(speaker_ids)}
+        if len(last) < len(speaker_ids):
+            speaker_ids = list(last)
+            ses = ses[list(last.values())]
+
+        rows = []
+        for speaker_id in speaker_ids:
+            if speaker_id in self.rows:
+                rows.append(self.rows[speaker_id])
+            elif len(self.free_rows) > 0:
+                rows.append(self.free_rows.pop())
+            else:
+                rows.append(len(self.ids))
+                self.ids.append(None)
+        self._grow(len(self.ids))
+        if len(self.norms) < len(self.ids):
+            self.norms = np.concatenate([self.norms, np.zeros(len(self.ids) - len(self.norms), dtype=np.float32)])
+
+        rows = np.asarray(rows)
+        norms = np.linalg.norm(ses, axis=1)
+        self.matrix[rows] = ses / np.maximum(norms, 1e-8)[:, None]
+        self.norms[rows] = norms
+        for speaker_id, row in zip(speaker_ids, rows):
+            self.ids[row] = speaker_id
+            self.rows[speaker_id] = int(row)
+
+    def import_se_files(self, se_paths, speaker_ids=None):
+        """Bulk load se.pth files written by extract_se, the ids default to the parent folder names."""
+        if speaker_ids is None:
+            speaker_ids = [os.path.basename(os.path.dirname(os.path.abspath(path))) for path in se_paths]
+        ses = [torch.load(path, map_location='cpu') for path in se_paths]
+        self.add_many(list(speaker_ids), ses)
+
+    def delete(self, speaker_id):
+        row = self.rows.pop(speaker_id)
+        self.ids[row] = None
+        self.matrix[row] = 0
+        self.norms[row] = 0
+        self.free_rows.append(row)
+
+    def get(self, speaker_id, device='cpu'):
+        row = self.rows[speaker_id]
+        return torch.from_numpy(self.matrix[row] * self.norms[row]).view(1, self.dim, 1).to(device)
+
+    def search(self, se, k=5, threshold=None):
+        """
+        Cosine nearest neighbours of an embedding: a list of (speaker_id, similarity), most similar first.
+        With a threshold only speakers at least that similar are returned, e.g. to deduplicate enrollments.
+        """
+        if len(self.rows) == 0:
+            return []
+        if torch.is_tensor(se):
+            se = se.detach().cpu().numpy()
+        query = np.asarray(se, dtype=np.float32).reshape(-1)
+        query = query / max(np.linalg.norm(query), 1e-8)
+        n = len(self.ids)
+        scores = np.asarray(self.matrix[:n]) @ query
+
+        # the zeroed rows of deleted speakers score 0, take enough candidates to skip them
+        n_candidates = min(k + len(self.free_rows), n)
+        top = np.argpartition(-scores, n_candidates - 1)[:n_candidates]
+        top = top[np.argsort(-scores[top])]
+        top = [row for row in top if self.ids[row] is not None][:k]
+        return [(self.ids[row], float(scores[row])) for row in top
+                if threshold is None or scores[row] >= threshold]
+
+    def flush(self):
+        self.matrix.flush()
+        index = {'dim': self.dim, 'capacity': self.capacity, 'ids': self.ids,
+                 'norms': self.norms[:len(self.ids)].tolist()}
+        tmp_path = f'{self.index_path}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(index, f)
+        os.replace(tmp_path, self.index_path)
+
+    def close(self):
+        self.flush()
+        del self.matrix
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
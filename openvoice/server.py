@@ -0,0 +1,269 @@
+"""
+Asyncio HTTP server: MeloTTS synthesis followed by OpenVoice tone color conversion.
+
+    python -m openvoice.server --reference resources/john1.mp3 --preload EN
+
+POST /convert   {"text": ..., "language": "EN", "speed": 1.0, "speaker_id": 0} -> audio/wav
+POST /stream    same body, WAV frames are sent sentence by sentence
+GET  /healthz   liveness
+GET  /readyz    200 only once the models are loaded and warmed up
+GET  /metrics   queue, batching and model registry statistics
+"""
+import io
+import os
+import asyncio
+import logging
+import argparse
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+import soundfile as sf
+from aiohttp import web
+
+from openvoice import se_extractor, streaming, utils
+from openvoice.api import ToneColorConverter
+from openvoice.batching import ConversionScheduler
+from openvoice.registry import ModelRegistry
+
+# languages MeloTTS has models for, anything else is rejected before a model is looked up
+MELO_LANGUAGES = ('EN', 'EN_NEWEST', 'ES', 'FR', 'ZH', 'JP', 'KR')
+
+
+class InvalidRequest(ValueError):
+    """A request the models cannot serve, answered with 400."""
+    pass
+
+
+class OpenVoiceServer(object):
+    def __init__(self, args):
+        self.args = args
+        self.device = args.device or ("cuda:0" if torch.cuda.is_available() else "cpu")
+        # model calls never run on the event loop, at most `workers` of them run at once
+        self.executor = ThreadPoolExecutor(max_workers=args.workers, thread_name_prefix='openvoice-worker')
+        self.pending = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.ready = False
+        self.failed = False
+        self.converter = None
+        self.scheduler = None
+        self.tts_models = None
+        self.target_se = None
+        self.source_ses = {}
+
+    def load(self):
+        args = self.args
+        logging.info(f"Using device: {self.device}")
+        self.converter = ToneColorConverter(os.path.join(args.ckpt_converter, 'config.json'), device=self.device)
+        self.converter.load_ckpt(os.path.join(args.ckpt_converter, 'checkpoint.pth'))
+        self.target_se, _ = se_extractor.get_se(args.reference, self.converter, target_dir=args.output_dir, vad=False)
+        self.source_ses = se_extractor.load_base_speaker_ses(args.base_speaker_ses, device=self.device)
+        self.scheduler = ConversionScheduler(self.converter, max_batch_size=args.max_batch_size,
+                                             max_wait_ms=args.max_wait_ms)
+
+        from melo.api import TTS
+        self.tts_models = ModelRegistry(lambda language: TTS(language=language, device=self.device),
+                                        max_bytes=args.tts_memory_mb * 1024 * 1024)
+        # warm up: load every preloaded language and run it end to end once
+        for language in args.preload:
+            self.synthesize('Hello world, this is a warm up.', language, 0, 1.0)
+        self.ready = True
+        logging.info("Models are loaded and warm.")
+
+    def synthesize(self, text, language, speaker_id, speed, source_se=None, message="default"):
+        with self.tts_models.acquire(language) as model:
+            if speaker_id not in model.hps.data.spk2id.values():
+                raise InvalidRequest(f"Unknown speaker_id {speaker_id} for language {language}, "
+                                     f"the speakers are {dict(model.hps.data.spk2id)}.")
+            tts_audio = model.tts_to_file(text, speaker_id, None, speed=speed, quiet=True)
+            sr = model.hps.data.sampling_rate
+            if source_se is None:
+                source_se = se_extractor.get_tts_source_se(model, speaker_id, tts_audio, sr, self.converter,
+                                                           self.source_ses, target_dir=self.args.output_dir)
+        audio = self.scheduler.convert(tts_audio, source_se, self.target_se, sr=sr, message=message)
+        return audio, source_se
+
+    def synthesize_wav(self, text, language, speaker_id, speed):
+        audio, _ = self.synthesize(text, language, speaker_id, speed)
+        output_buffer = io.BytesIO()
+        sf.write(output_buffer, audio, self.converter.hps.data.sampling_rate, format='WAV')
+        return output_buffer.getvalue()
+
+    def _release(self, future):
+        self.pending -= 1
+
+    def deadline(self):
+        """End of the request timeout, shared by every model call of a request."""
+        return asyncio.get_running_loop().time() + self.args.timeout
+
+    async def run_model(self, fn, *args, deadline):
+        """
+        Run fn in the worker pool within the time left until deadline. The slot is only released when
+        the call actually finishes, so timed out work still counts against the queue limit.
+        """
+        loop = asyncio.get_running_loop()
+        self.pending += 1
+        future = loop.run_in_executor(self.executor, fn, *args)
+        future.add_done_callback(self._release)
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), timeout=max(deadline - loop.time(), 0))
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            raise
+
+    async def parse_request(self, request):
+        try:
+            data = await request.json()
+        except Exception:
+            data = None
+        if not isinstance(data, dict):
+            raise web.HTTPUnsupportedMediaType(
+                text="Invalid input. Content-Type must be 'application/json' and body must be valid JSON.")
+        text = data.get('text')
+        if not text or not isinstance(text, str):
+            raise web.HTTPBadRequest(text='Text is a required field and must be a valid string.')
+        speed = data.get('speed', 1.0)
+        if isinstance(speed, bool) or not isinstance(speed, (int, float)) or not 0 < speed < 10:
+            raise web.HTTPBadRequest(text='Speed must be a number between 0 and 10.')
+        language = data.get('language', 'EN')
+        if language not in MELO_LANGUAGES:
+            raise web.HTTPBadRequest(text=f"Language must be one of {', '.join(MELO_LANGUAGES)}.")
+        speaker_id = data.get('speaker_id', 0)
+        if isinstance(speaker_id, bool) or not isinstance(speaker_id, int):
+            raise web.HTTPBadRequest(text='speaker_id must be an integer.')
+        return text, language, speaker_id, float(speed)
+
+    def check_capacity(self):
+        if not self.ready:
+            raise web.HTTPServiceUnavailable(text='Models are still loading.')
+        if self.pending >= self.args.max_queue:
+            self.rejected += 1
+            raise web.HTTPTooManyRequests(text='Server is busy, retry later.', headers={'Retry-After': '1'})
+
+    async def handle_convert(self, request):
+        text, language, speaker_id, speed = await self.parse_request(request)
+        self.check_capacity()
+        try:
+            wav = await self.run_model(self.synthesize_wav, text, language, speaker_id, speed,
+                                       deadline=self.deadline())
+        except asyncio.TimeoutError:
+            return web.json_response({'error': 'Request timed out.'}, status=504)
+        except InvalidRequest as e:
+            return web.json_response({'error': str(e)}, status=400)
+        except Exception as e:
+            logging.error(f"An error occurred: {str(e)}")
+            return web.json_response({'error': str(e), 'traceback': traceback.format_exc()}, status=500)
+        return web.Response(body=wav, content_type='audio/wav')
+
+    async def handle_stream(self, request):
+        text, language, speaker_id, speed = await self.parse_request(request)
+        self.check_capacity()
+        sentences = utils.split_sentence(text, language_str=se_extractor.melo_language_str(language))
+
+        response = web.StreamResponse(headers={'Content-Type': 'audio/wav'})
+        source_se = None
+        deadline = self.deadline()
+        # sentences are converted unwatermarked, the stream is watermarked as a whole
+        watermarker = self.converter.watermark_stream()
+        try:
+            for sentence in sentences:
+                audio, source_se = await self.run_model(self.synthesize, sentence, language, speaker_id, speed,
+                                                        source_se, None, deadline=deadline)
+                audio = await self.run_model(watermarker.write, audio, deadline=deadline)
+                if not response.prepared:
+                    await response.prepare(request)
+                    await response.write(streaming.wav_stream_header(self.converter.hps.data.sampling_rate))
+                await response.write(streaming.float_to_pcm16(audio))
+            await response.write(streaming.float_to_pcm16(watermarker.flush()))
+        except Exception as e:
+            if not response.prepared:
+                if isinstance(e, asyncio.TimeoutError):
+                    return web.json_response({'error': 'Request timed out.'}, status=504)
+                if isinstance(e, InvalidRequest):
+                    return web.json_response({'error': str(e)}, status=400)
+                logging.error(f"An error occurred: {str(e)}")
+                return web.json_response({'error': str(e), 'traceback': traceback.format_exc()}, status=500)
+            # the response has already started, all we can do is end the stream
+            logging.error(f"An error occurred while streaming: {e!r}")
+            return response
+        await response.write_eof()
+        return response
+
+    async def handle_health(self, request):
+        if self.failed:
+            return web.json_response({'status': 'failed'}, status=500)
+        return web.json_response({'status': 'ok'})
+
+    async def handle_ready(self, request):
+        if not self.ready:
+            return web.json_response({'status': 'failed' if self.failed else 'loading'}, status=503)
+        return web.json_response({'status': 'ready'})
+
+    async def handle_metrics(self, request):
+        metrics = {
+            'pending': self.pending,
+            'max_queue': self.args.max_queue,
+            'rejected': self.rejected,
+            'timeouts': self.timeouts,
+        }
+        if self.ready:
+            metrics['conversion'] = self.scheduler.stats()
+            metrics['tts_models'] = self.tts_models.stats()
+        return web.json_response(metrics)
+
+    async def on_startup(self, app):
+        loop = asyncio.get_running_loop()
+        # load in the background, /healthz answers meanwhile and /readyz turns green when done
+        app['loader'] = loop.run_in_executor(None, self.load)
+        app['loader'].add_done_callback(self._loaded)
+
+    def _loaded(self, future):
+        # a failed load turns /healthz red, so the process gets restarted instead of never becoming ready
+        if future.cancelled() or future.exception() is None:
+            return
+        logging.error("Loading the models failed.", exc_info=future.exception())
+        self.failed = True
+
+    def make_app(self):
+        app = web.Application()
+        app.add_routes([
+            web.post('/convert', self.handle_convert),
+            web.post('/stream', self.handle_stream),
+            web.get('/healthz', self.handle_health),
+            web.get('/readyz', self.handle_ready),
+            web.get('/metrics', self.handle_metrics),
+        ])
+        app.on_startup.append(self.on_startup)
+        return app
+
+
+def get_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--device', default=None)
+    parser.add_argument('--ckpt_converter', default='checkpoints_v2/converter')
+    parser.add_argument('--base_speaker_ses', default='checkpoints_v2/base_speakers/ses')
+    parser.add_argument('--reference', default='resources/john1.mp3', help="reference speaker to clone")
+    parser.add_argument('--output_dir', default='outputs_v2')
+    parser.add_argument('--preload', nargs='*', default=['EN'], help="languages to load and warm up at startup")
+    parser.add_argument('--workers', type=int, default=4, help="model calls running at once")
+    parser.add_argument('--max_queue', type=int, default=16, help="requests in flight before answering 429")
+    parser.add_argument('--timeout', type=float, default=60., help="per-request timeout in seconds, for /stream the whole stream")
+    parser.add_argument('--max_batch_size', type=int, default=8)
+    parser.add_argument('--max_wait_ms', type=float, default=5.)
+    parser.add_argument('--tts_memory_mb', type=int, default=4096)
+    return parser
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    args = get_parser().parse_args()
+    os.makedirs(args.output_dir, exist_ok=True)
+    server = OpenVoiceServer(args)
+    web.run_app(server.make_app(), host=args.host, port=args.port)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,34 @@
+import struct
+import numpy as np
+
+# RIFF / data chunk sizes of a stream whose final length is not known yet
+STREAMING_SIZE = 0xFFFFFFFF
+
+
+def wav_stream_header(sample_rate, channels=1, bits_per_sample=16):
+    """WAV header for 16-bit PCM that is followed by an open-ended stream of frames."""
+    block_align = channels * bits_per_sample // 8
+    byte_rate = sample_rate * block_align
+    return b''.join([
+        b'RIFF', struct.pack('<I', STREAMING_SIZE), b'WAVE',
+        b'fmt ', struct.pack('<IHHIIHH', 16, 1, channels, sample_rate, byte_rate, block_align, bits_per_sample),
+        b'data', struct.pack('<I', STREAMING_SIZE),
+    ])
+
+
+def float_to_pcm16(audio):
+    audio = np.clip(np.asarray(audio, dtype=np.float32).reshape(-1), -1.0, 1.0)
+    return (audio * 32767).astype('<i2').tobytes()
+
+
+def sentence_gap(sr, speed=1.0):
+    # the same silence BaseSpeakerTTS.audio_numpy_concat puts after every sentence
+    return np.zeros(int((sr * 0.05) / speed), dtype=np.float32)
+
+
+def stream_wav(audio_iter, sample_rate, header=True):
+    """Turn an iterator of float waveforms into WAV bytes, yielding each piece as soon as it is ready."""
+    if header:
+        yield wav_stream_header(sample_rate)
+    for audio in audio_iter:
+        yield float_to_pcm16(audio)
@@ -0,0 +1,103 @@
+"""
+Opt-in TorchScript for the inference entry points.
+
+voice_conversion is traced as a whole. In infer, the durations decide the output length, so only
+the flow and decoder after the length regulator are traced, the part that does most of the work.
+Time dimensions stay dynamic, the traces are for a batch of one and fall back to eager otherwise.
+Traces are saved next to the checkpoint, keyed by the config, checkpoint, torch version, device and the
+precision / quantization of the model, so later processes load them instead of tracing again.
+"""
+import os
+import hashlib
+import warnings
+
+import torch
+from torch import nn
+
+EXAMPLE_FRAMES = 200
+
+
+class VoiceConversion(nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, y, y_lengths, sid_src, sid_tgt, tau):
+        o_hat, y_mask, (z, z_p, z_hat) = self.model.voice_conversion(y, y_lengths, sid_src, sid_tgt, tau=tau)
+        return o_hat, y_mask, z, z_p, z_hat
+
+
+class FlowDecoder(nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.flow = model.flow
+        self.dec = model.dec
+
+    def forward(self, z_p, y_mask, g):
+        z = self.flow(z_p, y_mask, g=g, reverse=True)
+        o = self.dec(z * y_mask, g=g)
+        return o, z
+
+
+def example_inputs(name, hps, device):
+    gin_channels = getattr(hps.model, 'gin_channels', 256)
+    if name == 'voice_conversion':
+        spec = torch.rand(1, hps.data.filter_length // 2 + 1, EXAMPLE_FRAMES, device=device)
+        se = torch.randn(1, gin_channels, 1, device=device)
+        return (spec, torch.LongTensor([EXAMPLE_FRAMES]).to(device), se, se.flip(1),
+                torch.tensor(0.3, device=device))
+    if name == 'flow_decoder':
+        z_p = torch.randn(1, hps.model.inter_channels, EXAMPLE_FRAMES, device=device)
+        y_mask = torch.ones(1, 1, EXAMPLE_FRAMES, device=device)
+        return z_p, y_mask, torch.randn(1, gin_channels, 1, device=device)
+    raise ValueError(f"unknown entry point {name}")
+
+
+def trace(name, model, hps, device):
+    wrapper = VoiceConversion(model) if name == 'voice_conversion' else FlowDecoder(model)
+    # trace the eager graph, not an earlier trace
+    compiled = model.compiled.pop(name, None)
+    try:
+        with torch.no_grad(), warnings.catch_warnings():
+            warnings.simplefilter('ignore', torch.jit.TracerWarning)
+            traced = torch.jit.trace(wrapper.eval(), example_inputs(name, hps, device), check_trace=False)
+    finally:
+        if compiled is not None:
+            model.compiled[name] = compiled
+    return traced
+
+
+def cache_key(config_path, ckpt_path, device, variant=''):
+    h = hashlib.sha1()
+    with open(config_path, 'rb') as f:
+        h.update(f.read())
+    if ckpt_path is not None:
+        stat = os.stat(ckpt_path)
+        h.update(f'{os.path.realpath(ckpt_path)}:{stat.st_size}:{stat.st_mtime_ns}'.encode())
+    h.update(f'{torch.__version__}:{device}'.encode())
+    if variant:
+        h.update(variant.encode())
+    return h.hexdigest()[:16]
+
+
+def cache_path(name, config_path, ckpt_path, device, variant=''):
+    base = ckpt_path if ckpt_path is not None else config_path
+    return f'{os.path.splitext(base)[0]}.{name}.{cache_key(config_path, ckpt_path, device, variant)}.ts.pt'
+
+
+def load_or_trace(name, model, hps, config_path, ckpt_path, device, cache=True, variant=''):
+    """variant: what changed the weights after loading ckpt_path, e.g. quantization, part of the cache key"""
+    path = cache_path(name, config_path, ckpt_path, device, variant)
+    if cache and os.path.isfile(path):
+        print(f"Loading TorchScript {name} from '{path}'")
+        return torch.jit.load(path, map_location=device)
+    traced = trace(name, model, hps, device)
+    if cache:
+        tmp_path = f'{path}.tmp'
+        try:
+            torch.jit.save(traced, tmp_path)
+            os.replace(tmp_path, path)
+            print(f"Saved TorchScript {name} to '{path}'")
+        except OSError as e:
+            print(f"Could not cache TorchScript {name}: {e}")
+    return traced
@@ -28,17 +28,19 @@ def piecewise_rational_quadratic_transform(
         spline_fn = unconstrained_rational_quadratic_spline
         spline_kwargs = {"tails": tails, "tail_bound": tail_bound}
 
-    outputs, logabsdet = spline_fn(
-        inputs=inputs,
-        unnormalized_widths=unnormalized_widths,
-        unnormalized_heights=unnormalized_heights,
-        unnormalized_derivatives=unnormalized_derivatives,
-        inverse=inverse,
-        min_bin_width=min_bin_width,
-        min_bin_height=min_bin_height,
-        min_derivative=min_derivative,
-        **spline_kwargs
-    )
+    # the spline (softmax, cumsum, square roots) is always computed in fp32, also under autocast
+    with torch.autocast(device_type=inputs.device.type, enabled=False):
+        outputs, logabsdet = spline_fn(
+            inputs=inputs.float(),
+            unnormalized_widths=unnormalized_widths.float(),
+            unnormalized_heights=unnormalized_heights.float(),
+            unnormalized_derivatives=unnormalized_derivatives.float(),
+            inverse=inverse,
+            min_bin_width=min_bin_width,
+            min_bin_height=min_bin_height,
+            min_derivative=min_derivative,
+            **spline_kwargs
+        )
     return outputs, logabsdet
 
 
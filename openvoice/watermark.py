@@ -0,0 +1,244 @@
+"""
+Batched wavmark watermark decoding and bulk scanning of generated audio.
+
+    python -m openvoice.watermark outputs_v2 --workers 4
+"""
+import os
+import time
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+import librosa
+
+from openvoice import utils, pipeline
+
+K = 16000  # samples per watermarked chunk
+COEFF = 2  # a chunk starts every COEFF * K samples
+AUDIO_EXTENSIONS = ('.wav', '.flac', '.mp3', '.ogg', '.m4a')
+
+_models = {}
+_models_lock = threading.Lock()
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_watermark_model(device='cpu'):
+    """The wavmark model on device, loaded on first use and shared by every converter in the process."""
+    device = str(device)
+    with _models_lock:
+        if device not in _models:
+            import wavmark
+            _models[device] = wavmark.load_model().to(device).eval()
+        return _models[device]
+
+
+def get_watermark_executor(max_workers=1):
+    """Thread pool running watermarking as a post-processing stage, off the conversion path."""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='openvoice-watermark')
+        return _executor
+
+
+def default_n_repeat():
+    """Chunks holding one message, string_to_bits pads every message to the same number of bits."""
+    return len(utils.string_to_bits('default').reshape(-1)) // 32
+
+
+def chunk_index(n_samples, n_chunks):
+    """Sample indices [n, K] of the first n_chunks watermark chunks, fewer if the audio is too short."""
+    n_fit = (n_samples - K) // (COEFF * K) + 1 if n_samples >= K else 0
+    n_chunks = min(n_chunks, n_fit)
+    return COEFF * K * np.arange(n_chunks)[:, None] + np.arange(K)[None]
+
+
+def encode_chunks(watermark_model, signals, bits, device='cpu'):
+    """Watermarked chunks [n, K] of the chunks signals [n, K], chunk i carries bits[i] ([n, 32])."""
+    with torch.no_grad():
+        signal = torch.FloatTensor(np.asarray(signals, dtype=np.float32)).to(device)
+        message = torch.FloatTensor(np.asarray(bits, dtype=np.float32)).to(device)
+        return watermark_model.encode(signal, message).detach().cpu().numpy()
+
+
+def decode_chunks(watermark_model, signals, device='cpu'):
+    """Soft decoded bits [n, 32] of the chunks [n, K], in one forward pass."""
+    with torch.no_grad():
+        signal = torch.FloatTensor(np.asarray(signals, dtype=np.float32)).to(device)
+        return watermark_model.decode(signal).detach().cpu().numpy()
+
+
+def decoded_to_message(decoded):
+    """
+    Message and confidence from the soft decoded bits of its chunks.
+    The confidence is the mean distance of the bits from the 0.5 decision threshold,
+    1 when every bit decodes to exactly 0 or 1 and 0 when all are undecided.
+    """
+    bits = (decoded >= 0.5).astype(int).reshape(-1, 8)
+    confidence = float(np.clip(np.abs(decoded - 0.5) * 2, 0, 1).mean())
+    return utils.bits_to_string(bits), confidence
+
+
+class StreamWatermarker(object):
+    """
+    Watermark audio that is produced piece by piece, e.g. sentence by sentence, with the chunk layout
+    add_watermark uses on the whole clip: chunk i starts at sample COEFF * K * i of the stream, not of
+    the piece. Samples are held back only while the chunk they belong to is incomplete.
+
+        watermarker = StreamWatermarker(model, 'default')
+        for piece in pieces:
+            send(watermarker.write(piece))
+        send(watermarker.flush())
+
+    Concatenated, the returned pieces are what add_watermark returns for the concatenated input.
+    With watermark_model None the pieces pass through unchanged.
+    """
+
+    def __init__(self, watermark_model, message='default', device='cpu'):
+        self.watermark_model = watermark_model
+        self.device = device
+        bits = utils.string_to_bits(message).reshape(-1)
+        self.n_repeat = len(bits) // 32
+        self.bits = bits[:self.n_repeat * 32].reshape(self.n_repeat, 32)
+        self.n_chunks = 0 if watermark_model is None else self.n_repeat
+        self.next_chunk = 0
+        # stream position of buffer[0]
+        self.offset = 0
+        self.buffer = np.zeros(0, dtype=np.float32)
+
+    def write(self, audio):
+        """Append a piece, returns the samples that are final, possibly none."""
+        if torch.is_tensor(audio):
+            audio = audio.detach().cpu().numpy()
+        self.buffer = np.concatenate([self.buffer, np.asarray(audio, dtype=np.float32).reshape(-1)])
+        end = self.offset + len(self.buffer)
+
+        # every chunk completed by this piece is watermarked in one encode call
+        complete = [i for i in range(self.next_chunk, self.n_chunks) if COEFF * K * i + K <= end]
+        if len(complete) > 0:
+            index = COEFF * K * np.asarray(complete)[:, None] + np.arange(K)[None] - self.offset
+            self.buffer[index] = encode_chunks(self.watermark_model, self.buffer[index], self.bits[complete],
+                                               self.device)
+            self.next_chunk += len(complete)
+
+        ready = end if self.next_chunk >= self.n_chunks else min(end, COEFF * K * self.next_chunk)
+        audio, self.buffer = self.buffer[:ready - self.offset], self.buffer[ready - self.offset:]
+        self.offset = ready
+        return audio
+
+    def flush(self):
+        """End of the stream, returns the held back samples."""
+        if self.next_chunk < self.n_chunks:
+            print('Audio too short, fail to add watermark')
+        audio, self.buffer = self.buffer, np.zeros(0, dtype=np.float32)
+        self.offset += len(audio)
+        self.n_chunks = self.next_chunk
+        return audio
+
+
+def list_audio_files(root):
+    paths = []
+    for dirpath, _, filenames in os.walk(root):
+        for filename in filenames:
+            if filename.lower().endswith(AUDIO_EXTENSIONS):
+                paths.append(os.path.join(dirpath, filename))
+    return sorted(paths)
+
+
+def scan_watermarks(watermark_model, sources, device='cpu', n_repeat=None, workers=4, batch_size=16):
+    """
+    Detect the watermark of many files.
+    sources: a directory (searched recursively) or a list of paths / waveforms. Files are read at their
+    own sampling rate, the one the watermark was added at.
+    Files are decoded by a pool of `workers` threads, and the chunks of up to batch_size files are
+    decoded together in one forward pass.
+    Returns a list of {'source', 'message', 'confidence'}, in order, and the throughput statistics.
+    source is the path, or the list position of a waveform; message is None for audio too short to hold
+    a watermark.
+    """
+    if isinstance(sources, str):
+        sources = list_audio_files(sources)
+    n_repeat = default_n_repeat() if n_repeat is None else n_repeat
+
+    def load(item):
+        i, source = item
+        if isinstance(source, str):
+            audio, _ = librosa.load(source, sr=None)
+            return source, audio
+        if torch.is_tensor(source):
+            source = source.detach().cpu().numpy()
+        return i, np.asarray(source, dtype=np.float32).reshape(-1)
+
+    timer = pipeline.StageTimer()
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='openvoice-scan')
+    results = []
+    start = time.perf_counter()
+
+    def run_batch(batch):
+        chunks = []
+        for _, audio in batch:
+            index = chunk_index(len(audio), n_repeat)
+            chunks.append(audio[index] if len(index) == n_repeat else np.zeros((0, K), dtype=np.float32))
+        with timer.stage('decode'):
+            signals = np.concatenate(chunks)
+            decoded = decode_chunks(watermark_model, signals, device) if len(signals) > 0 else None
+        offset = 0
+        for (source, _), chunk in zip(batch, chunks):
+            if len(chunk) == 0:
+                results.append({'source': source, 'message': None, 'confidence': 0.})
+                continue
+            message, confidence = decoded_to_message(decoded[offset:offset + len(chunk)])
+            offset += len(chunk)
+            results.append({'source': source, 'message': message, 'confidence': confidence})
+
+    try:
+        batch = []
+        for item in pipeline.prefetch_map(load, enumerate(sources), executor=executor, depth=2 * workers,
+                                          timer=timer, stage='load'):
+            batch.append(item)
+            if len(batch) == batch_size:
+                run_batch(batch)
+                batch = []
+        if len(batch) > 0:
+            run_batch(batch)
+    finally:
+        executor.shutdown(wait=False)
+
+    seconds = time.perf_counter() - start
+    stats = {
+        'files': len(results),
+        'seconds': seconds,
+        'files_per_second': len(results) / max(seconds, 1e-9),
+        'timings': timer.summary(),
+    }
+    print(f"Scanned {stats['files']} files in {seconds:.2f}s ({stats['files_per_second']:.1f} files/s)")
+    return results, stats
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description="Detect the OpenVoice watermark in a folder of audio files.")
+    parser.add_argument('input', help="folder searched recursively for audio files")
+    parser.add_argument('--device', default=None)
+    parser.add_argument('--workers', type=int, default=4, help="threads decoding audio files")
+    parser.add_argument('--batch_size', type=int, default=16, help="files decoded in one forward pass")
+    parser.add_argument('--n_repeat', type=int, default=None)
+    parser.add_argument('--min_confidence', type=float, default=0., help="only list files at least this confident")
+    return parser
+
+
+def main():
+    args = get_parser().parse_args()
+    device = args.device or ("cuda:0" if torch.cuda.is_available() else "cpu")
+    watermark_model = get_watermark_model(device)
+    results, _ = scan_watermarks(watermark_model, args.input, device=device, n_repeat=args.n_repeat,
+                                 workers=args.workers, batch_size=args.batch_size)
+    for result in results:
+        if result['message'] is not None and result['confidence'] >= args.min_confidence:
+            print(f"{result['source']}\t{result['message']!r}\t{result['confidence']:.3f}")
+
+
+if __name__ == '__main__':
+    main()
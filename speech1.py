@@ -4,6 +4,8 @@ from flask import Flask, request, jsonify, send_file
 import logging
 from openvoice import se_extractor
 from openvoice.api import ToneColorConverter
+from openvoice.registry import ModelRegistry
+from openvoice.batching import ConversionScheduler
 from melo.api import TTS
 import traceback
 import io
@@ -39,9 +41,34 @@ logging.info(f"Extracting speaker embedding from reference speaker: {reference_s
 target_se, audio_name = se_extractor.get_se(reference_speaker, tone_color_converter, vad=False)
 logging.info("Speaker embedding extracted successfully.")
 
+# Preload the source tone color of every MeloTTS base speaker, so requests never
+# have to run Whisper and the reference encoder on the TTS output
+use_base_speaker_ses = os.environ.get('OPENVOICE_BASE_SPEAKER_SES', '1') == '1'
+base_speaker_ses_dir = 'checkpoints_v2/base_speakers/ses'
+source_ses = {}
+if use_base_speaker_ses:
+    source_ses = se_extractor.load_base_speaker_ses(base_speaker_ses_dir, device=device)
+    logging.info(f"Loaded {len(source_ses)} base speaker embeddings: {', '.join(source_ses.keys())}")
+
+
+# TTS models are loaded once per language and stay resident across requests
+tts_memory_mb = int(os.environ.get('OPENVOICE_TTS_MEMORY_MB', '4096'))
+tts_models = ModelRegistry(lambda language: TTS(language=language, device=device),
+                           max_bytes=tts_memory_mb * 1024 * 1024)
+
+# Concurrent /convert requests share batched forward passes of the converter
+conversion_scheduler = ConversionScheduler(
+    tone_color_converter,
+    max_batch_size=int(os.environ.get('OPENVOICE_MAX_BATCH_SIZE', '8')),
+    max_wait_ms=float(os.environ.get('OPENVOICE_MAX_WAIT_MS', '5')))
+
 # Initialize Flask app
 app = Flask(__name__)
 
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return jsonify({'conversion': conversion_scheduler.stats(), 'tts_models': tts_models.stats()})
+
 @app.route('/convert', methods=['POST'])
 def convert_text_to_speech():
     try:
@@ -60,44 +87,38 @@ def convert_text_to_speech():
             logging.error("Text is a required field.")
             return jsonify({'error': 'Text is a required field.'}), 400
 
-        # Create temporary files
-        temp_tts_file = 'temp_tts_output.wav'
-        
-        try:
-            # Generate TTS audio to temporary file
-            model = TTS(language=language, device=device)
-            model.tts_to_file(text, speaker_id, temp_tts_file, speed=speed)
-            
-            # Extract source speaker embedding from the TTS output
-            source_se, _ = se_extractor.get_se(temp_tts_file, tone_color_converter, vad=False)
-            
-            # Convert tone color
-            converted_audio = tone_color_converter.convert(
-                temp_tts_file,
-                source_se,
-                target_se)
-                
-            # Create output buffer for streaming
-            output_buffer = io.BytesIO()
-            
-            # Write the converted audio to the buffer using the TTS model's sampling rate
-            sampling_rate = 24000  # OpenVoice typically uses 24kHz
-            sf.write(output_buffer, converted_audio, sampling_rate, format='WAV')
-            
-            # Prepare buffer for streaming
-            output_buffer.seek(0)
-            
-            return send_file(
-                output_buffer,
-                mimetype='audio/wav',
-                as_attachment=True,
-                download_name='output.wav'
-            )
-
-        finally:
-            # Clean up temporary file
-            if os.path.exists(temp_tts_file):
-                os.remove(temp_tts_file)
+        # Generate TTS audio in memory
+        with tts_models.acquire(language) as model:
+            tts_audio = model.tts_to_file(text, speaker_id, None, speed=speed)
+            tts_sampling_rate = model.hps.data.sampling_rate
+
+            # Source speaker embedding of the TTS output
+            source_se = se_extractor.get_tts_source_se(model, speaker_id, tts_audio, tts_sampling_rate,
+                                                       tone_color_converter, source_ses, target_dir=output_dir)
+
+        # Convert tone color in a micro-batch, the waveform is only resampled if the rates differ
+        converted_audio = conversion_scheduler.convert(
+            tts_audio,
+            source_se,
+            target_se,
+            sr=tts_sampling_rate)
+
+        # Create output buffer for streaming
+        output_buffer = io.BytesIO()
+
+        # Write the converted audio to the buffer at the converter's sampling rate
+        sampling_rate = tone_color_converter.hps.data.sampling_rate
+        sf.write(output_buffer, converted_audio, sampling_rate, format='WAV')
+
+        # Prepare buffer for streaming
+        output_buffer.seek(0)
+
+        return send_file(
+            output_buffer,
+            mimetype='audio/wav',
+            as_attachment=True,
+            download_name='output.wav'
+        )
 
     except Exception as e:
         logging.error(f"An error occurred: {str(e)}")
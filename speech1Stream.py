@@ -1,14 +1,13 @@
 import os
 import torch
-from flask import Flask, request, jsonify, Response
+from flask import Flask, request, jsonify, Response, stream_with_context
 from flask_cors import CORS
 import logging
-from openvoice import se_extractor
+from openvoice import se_extractor, streaming, utils
 from openvoice.api import ToneColorConverter
+from openvoice.registry import ModelRegistry
 from melo.api import TTS
 import traceback
-import io
-import soundfile as sf
 
 # Configure logging
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s %(levelname)s %(message)s')
@@ -34,18 +33,45 @@ reference_speaker = 'resources/john1.mp3'  # Path to the new voice sample
 target_se, audio_name = se_extractor.get_se(reference_speaker, tone_color_converter, vad=False)
 logging.info("Speaker embedding extracted successfully.")
 
+# TTS models are loaded once per language and stay resident across requests
+tts_memory_mb = int(os.environ.get('OPENVOICE_TTS_MEMORY_MB', '4096'))
+tts_models = ModelRegistry(lambda language: TTS(language=language, device=device),
+                           max_bytes=tts_memory_mb * 1024 * 1024)
+
+# Preload the source tone color of every MeloTTS base speaker
+source_ses = se_extractor.load_base_speaker_ses('checkpoints_v2/base_speakers/ses', device=device)
+logging.info(f"Loaded {len(source_ses)} base speaker embeddings.")
+
 # Initialize Flask app
 app = Flask(__name__)
 CORS(app)  # Enable CORS for all routes
 
-def stream_audio(file_path):
-    """Generator function to stream audio in chunks."""
-    with open(file_path, 'rb') as f:
-        while True:
-            chunk = f.read(4096)  # Read in 4KB chunks
-            if not chunk:
-                break
+def synthesize_stream(text, language, speaker_id, speed):
+    """Generator function that synthesizes and tone-converts the text sentence by sentence."""
+    # MeloTTS appends the sentence gap to every piece it synthesizes
+    source_se = None
+    # sentences are converted unwatermarked, the stream is watermarked as a whole
+    watermarker = tone_color_converter.watermark_stream()
+    for sentence in utils.split_sentence(text, language_str=se_extractor.melo_language_str(language)):
+        with tts_models.acquire(language) as model:
+            tts_audio = model.tts_to_file(sentence, speaker_id, None, speed=speed, quiet=True)
+            tts_sampling_rate = model.hps.data.sampling_rate
+            if source_se is None:
+                source_se = se_extractor.get_tts_source_se(model, speaker_id, tts_audio, tts_sampling_rate,
+                                                           tone_color_converter, source_ses, target_dir=output_dir)
+        yield watermarker.write(tone_color_converter.convert(tts_audio, source_se, target_se,
+                                                             sr=tts_sampling_rate, message=None))
+    yield watermarker.flush()
+
+def stream_audio(text, language, speaker_id, speed):
+    """Generator function to stream WAV frames as soon as each sentence is ready."""
+    sampling_rate = tone_color_converter.hps.data.sampling_rate
+    try:
+        for chunk in streaming.stream_wav(synthesize_stream(text, language, speaker_id, speed), sampling_rate):
             yield chunk
+    except Exception as e:
+        # the response has already started, all we can do is end the stream
+        logging.error(f"An error occurred while streaming: {str(e)}\n{traceback.format_exc()}")
 
 @app.route('/convert', methods=['POST'])
 def convert_text_to_speech():
@@ -65,30 +91,12 @@ def convert_text_to_speech():
             logging.error("Text is a required field and must be a valid string.")
             return jsonify({'error': 'Text is a required field and must be a valid string.'}), 400
 
-        # Create temporary files
-        output_dir = 'outputs_v2'  # Assuming this is defined earlier in your code
-        temp_tts_file = os.path.join(output_dir, 'temp_tts_output.wav')
-        
-        # Generate TTS audio to temporary file
-        model = TTS(language=language, device=device)
-        model.tts_to_file(text, speaker_id, temp_tts_file, speed=speed)  # Use existing method
-        
-        # Check if the file was created and has content
-        if not os.path.exists(temp_tts_file) or os.path.getsize(temp_tts_file) == 0:
-            logging.error("No audio segments found! The TTS model did not generate any audio.")
-            return jsonify({'error': 'No audio segments found! The TTS model did not generate any audio.'}), 500
-        
-        # Stream the audio file in chunks
-        return Response(stream_audio(temp_tts_file), mimetype='audio/wav')
+        # Stream the audio sentence by sentence, the first one is sent before the rest is synthesized
+        return Response(stream_with_context(stream_audio(text, language, speaker_id, speed)), mimetype='audio/wav')
 
     except Exception as e:
         logging.error(f"An error occurred: {str(e)}")
         return jsonify({'error': str(e), 'traceback': traceback.format_exc()}), 500
 
-    finally:
-        # Clean up temporary file after streaming
-        if os.path.exists(temp_tts_file):
-            os.remove(temp_tts_file)
-
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000, debug=False)
\ No newline at end of file
+    app.run(host='0.0.0.0', port=5000, debug=False)
@@ -0,0 +1,30 @@
+import json
+
+import pytest
+import torch
+
+# the v2 tone color converter config, the models are built with random weights
+CONVERTER_CONFIG = {
+    "_version_": "v2",
+    "data": {"sampling_rate": 22050, "filter_length": 1024, "hop_length": 256, "win_length": 1024,
+             "n_speakers": 0},
+    "model": {"zero_g": True, "inter_channels": 192, "hidden_channels": 192, "filter_channels": 768,
+              "n_heads": 2, "n_layers": 6, "kernel_size": 3, "p_dropout": 0.1, "resblock": "1",
+              "resblock_kernel_sizes": [3, 7, 11], "resblock_dilation_sizes": [[1, 3, 5], [1, 3, 5], [1, 3, 5]],
+              "upsample_rates": [8, 8, 2, 2], "upsample_initial_channel": 512,
+              "upsample_kernel_sizes": [16, 16, 4, 4], "gin_channels": 256},
+}
+
+
+@pytest.fixture
+def converter_config(tmp_path):
+    config_path = tmp_path / 'config.json'
+    config_path.write_text(json.dumps(CONVERTER_CONFIG))
+    return str(config_path)
+
+
+@pytest.fixture
+def converter(converter_config):
+    from openvoice.api import ToneColorConverter
+    torch.manual_seed(0)
+    return ToneColorConverter(converter_config, device='cpu', enable_watermark=False)
@@ -0,0 +1,15 @@
+import pytest
+
+pytest.importorskip('onnx')
+pytest.importorskip('onnxruntime')
+
+from openvoice import onnx_export
+from openvoice.api import OnnxToneColorConverter
+
+
+def test_onnxruntime_matches_pytorch(converter, converter_config, tmp_path):
+    onnx_dir = str(tmp_path / 'onnx')
+    onnx_export.export_converter(converter, onnx_dir)
+    onnx_converter = OnnxToneColorConverter(converter_config, onnx_dir, enable_watermark=False)
+    deviations = onnx_export.check_parity(converter, onnx_converter, atol=1e-4)
+    assert set(deviations) == {'ref_enc', 'voice_conversion'}
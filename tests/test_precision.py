@@ -0,0 +1,5 @@
+def test_bf16_deviation_is_bounded(converter):
+    converter.optimize_for_inference()
+    deviations = converter.check_precision(max_rel_deviation=0.05)
+    assert len(deviations) > 0
+    assert converter.precision == 'fp32'